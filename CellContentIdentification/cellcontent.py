@@ -1,5 +1,7 @@
 import cv2 as cv
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 def thresholding(img, threshold):
     '''
@@ -26,13 +28,21 @@ def morph(img, kernel_size = 7, close_first=False,iterations=2):
         img = cv.morphologyEx(img, cv.MORPH_CLOSE, kernel, iterations=iterations)
     return img
 
-def remove_small_patches(img, min_size):
+def remove_small_patches(img, min_size, return_stats=False):
+    '''
+    Removes (in place) the 8-connected patches of img smaller than min_size pixels.
+    If return_stats is True, also returns the connectedComponentsWithStats stats of the kept patches (background excluded),
+    e.g. to count cells without computing the connected components again.
+    '''
     # Find the connected components in the image
     num_labels, labels, stats, _ = cv.connectedComponentsWithStats(img, connectivity=8)
-    # Remove the small patches
-    for i in range(1, num_labels):
-        if stats[i, cv.CC_STAT_AREA] < min_size:
-            img[labels == i] = 0
+    # Lookup table of the labels to keep, applied to all pixels at once
+    keep = stats[:, cv.CC_STAT_AREA] >= min_size
+    keep[0] = True # Background
+    if not keep.all():
+        np.multiply(img, keep.astype(img.dtype)[labels], out=img)
+    if return_stats:
+        return img, stats[1:][keep[1:]]
     return img
 
 def _region_growing(image, seed_point, visited, mask, threshold:int, max_iterations:int=10000000, min_size:int=700):
@@ -72,8 +82,10 @@ def _region_growing(image, seed_point, visited, mask, threshold:int, max_iterati
         for point in region:
             mask[point] = 1
 
-def region_growing(image, gradient_threshold:int=4, value_threshold:int=160, min_size:int=700, verbose:bool=False):
-
+def region_growing_reference(image, gradient_threshold:int=4, value_threshold:int=160, min_size:int=700, verbose:bool=False):
+    '''
+    Pixel by pixel implementation of region_growing(), kept to check the results of the fast one. Very slow on full frames.
+    '''
     input_image = np.uint8(image)
     if verbose:
         print(f"Input images type: {type(input_image)}")
@@ -89,4 +101,40 @@ def region_growing(image, gradient_threshold:int=4, value_threshold:int=160, min
             if (visited[x, y] == 0) and (input_image[x, y] > value_threshold):
                 _region_growing(input_image, (x, y), visited, mask, gradient_threshold, value_threshold, min_size=min_size)
     
-    return mask
\ No newline at end of file
+    return mask
+
+def region_growing(image, gradient_threshold:int=4, value_threshold:int=160, min_size:int=700, verbose:bool=False):
+    '''
+    Region growing with 4-connectivity: regions grow from seed pixels (value > value_threshold) to the neighbours whose
+    absolute difference with the current pixel is <= gradient_threshold. Regions bigger than min_size pixels are kept.
+    Same result as region_growing_reference(), computed as the connected components of the graph linking the 4-neighbours
+    with a small enough gradient: a region is the component of its seed.
+    Returns a float64 mask with 1 on the kept regions.
+    '''
+    input_image = np.uint8(image)
+    if verbose:
+        print(f"Input images type: {type(input_image)}")
+        print(f"Input images shape: {input_image.shape}")
+
+    rows, cols = input_image.shape[:2]
+    values = input_image.astype(np.int16)
+    pixel_idx = np.arange(rows * cols).reshape(rows, cols)
+
+    # Edges between vertical and horizontal neighbours with a gradient below the threshold
+    vertical = np.abs(values[1:, :] - values[:-1, :]) <= gradient_threshold
+    horizontal = np.abs(values[:, 1:] - values[:, :-1]) <= gradient_threshold
+    src = np.concatenate([pixel_idx[:-1, :][vertical], pixel_idx[:, :-1][horizontal]])
+    dst = np.concatenate([pixel_idx[1:, :][vertical], pixel_idx[:, 1:][horizontal]])
+    graph = coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(rows * cols, rows * cols)).tocsr()
+    n_regions, labels = connected_components(graph, directed=False)
+
+    # Keep the regions containing a seed and bigger than min_size
+    sizes = np.bincount(labels, minlength=n_regions)
+    seeded = np.zeros(n_regions, dtype=bool)
+    seeded[labels[input_image.reshape(-1) > value_threshold]] = True
+    keep = seeded & (sizes > min_size)
+    if verbose:
+        print(f"{n_regions} regions, {seeded.sum()} seeded, {keep.sum()} kept")
+
+    mask = keep[labels].reshape(rows, cols).astype(np.float64)
+    return mask
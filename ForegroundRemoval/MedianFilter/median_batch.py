@@ -1,18 +1,14 @@
-import glob
+import glob, os, sys
 import cv2 as cv
-import numpy as np
-import dask.array as da
-from dask import delayed
 from skimage.io import imread
 import timeit
 import re
 from datetime import datetime
 
-
-# Define a function to read an image
-@delayed
-def read_image(path):
-    return imread(path)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from rankfilter import tiled_percentile
+from resultcache import ResultCache
+from functools import partial
 
 
 image_folder = "/Users/cyrilmonette/Desktop/EPFL 2018-2026/PhD - Mobots/data/24.09-24.10_observation_OH/Images/h1r1_1minute/"
@@ -26,6 +22,9 @@ files = files[:1000]
 
 n = 100  # median of 100 images = 100 * 1 min = 100 min = 1.6667 hours
 image_interval = 12  # Use one image every = 12 * 1 min = 12 minutes
+max_ram_bytes = 8 * 2**30  # Memory ceiling of the median computation, the stack is spilled to disk above it
+# Medians computed before from the same images are loaded instead of computed again (same key as median_image.median_filter)
+result_cache = ResultCache(os.path.join(p_out, 'cache'))
 
 n_files = range(0, len(files)-n, image_interval)  # Number of generated images
 
@@ -35,19 +34,9 @@ for i in n_files:
     # List of image paths
     image_paths = files[i:i+n]
 
-    # Use Dask's delayed function to create a lazy evaluation of the function
-    delayed_images = [da.from_delayed(read_image(path), shape=(cv.imread(image_paths[0]).shape), dtype=np.uint8) for path in image_paths]
-
-    # Stack all the images into a Dask array
-    images = da.stack(delayed_images, axis=0)
-    first_image = np.array(images[0].compute(), dtype=np.uint8)
-
-    # Calculate the median along the new dimension
-    median_image = np.median(images, axis=0)
-
-    # convert to numpy array so it can be displayed by CV2
-    median_image = median_image.compute()
-    median_image = np.array(median_image, dtype=np.uint8)
+    # Calculate the median by bands, reading each image once, with bounded memory
+    median_image = result_cache.get_or_compute(image_paths, 'median', {'read_scale': None},
+                                               partial(tiled_percentile, image_paths, imread, 50, max_ram_bytes=max_ram_bytes))
 
     end_time = timeit.default_timer()
 
@@ -1,31 +1,70 @@
-import cv2 as cv
 import numpy as np
 import dask.array as da
 from dask import delayed
 from skimage.io import imread
 import timeit
+from functools import partial
+from rankfilter import tiled_percentile
+from framecache import FrameCache
+from framestore import FrameStore
+from imgio import read_image as _read_image
+from resultcache import ResultCache
+from tracing import traced
+
+READ_PARAMS = ('imread',) # No preprocessing, part of the FrameCache key
+_imread = traced('decode', path_arg=0)(imread)
+
+def _read(path, cache:FrameCache=None, read_scale=None):
+    if read_scale is None:
+        read, params = partial(_imread, path), READ_PARAMS
+    else:
+        read, params = partial(_read_image, path, gray=True, scale=read_scale), ('imgio', 'gray', read_scale)
+    if cache is None:
+        return read()
+    return cache.get_or_compute(path, params, read)
 
 # Define a function to read an image
 @delayed
-def read_image(path):
-    return imread(path)
+def read_image(path, cache:FrameCache=None, read_scale=None):
+    return _read(path, cache, read_scale)
 
 
-def median_filter(image_list,paths = False):
+@traced(frames=lambda image_list, *args, **kwargs: len(image_list))
+def median_filter(image_list,paths = False, cache:FrameCache = None, tiled = False, max_ram_bytes = 4 * 2**30, tmp_dir = None, read_scale = None, result_cache:ResultCache = None):
     '''
     This function takes a list of images and returns the median image.
     params:
-    image_list: list of images (images or paths)
+    image_list: list of images (images or paths), or a FrameStore
     paths: if True, image_list is a list of paths, else a list of images directly
+    cache: FrameCache (e.g. framecache.frame_cache), if provided and paths is True, images are read from it and added to it
+    tiled: if True, the median is computed by bands with memory bounded by max_ram_bytes, spilling the stack to tmp_dir if needed (same output)
+    read_scale: if given and paths is True, images are decoded straight to grayscale at this scale (see imgio.read_image)
+    result_cache: ResultCache, if provided and paths is True, the median is loaded from it if it was computed before from the same images, else computed and stored in it
     '''
+    if result_cache is not None and paths:
+        compute = partial(median_filter, image_list, paths=paths, cache=cache, tiled=tiled, max_ram_bytes=max_ram_bytes, tmp_dir=tmp_dir, read_scale=read_scale)
+        return result_cache.get_or_compute(image_list, 'median', {'read_scale': read_scale}, compute)
+
     start_time = timeit.default_timer()
+    if tiled:
+        read = partial(_read, cache=cache, read_scale=read_scale) if paths else np.asarray
+        median_image = tiled_percentile(image_list, read, 50, max_ram_bytes=max_ram_bytes, tmp_dir=tmp_dir)
+        end_time = timeit.default_timer()
+        return median_image
+
     if paths:
-        delayed_images = [da.from_delayed(read_image(path), shape=(cv.imread(image_list[0]).shape), dtype=np.uint8) for path in image_list]
+        shape = _read(image_list[0], cache, read_scale).shape
+        delayed_images = [da.from_delayed(read_image(path, cache, read_scale), shape=shape, dtype=np.uint8) for path in image_list]
+    elif isinstance(image_list, FrameStore):
+        delayed_images = image_list.to_dask() # Memory-mapped frames, no decoding nor copy
     else:
         delayed_images = image_list
 
     # Stack all the images into a Dask array
-    images = da.stack(delayed_images, axis=0)
+    if isinstance(delayed_images, da.Array):
+        images = delayed_images
+    else:
+        images = da.stack(delayed_images, axis=0)
 
     # Calculate the median along the new dimension
     median_image = np.median(images, axis=0)
@@ -37,4 +76,4 @@ def median_filter(image_list,paths = False):
     end_time = timeit.default_timer()
 
 
-    return median_image
\ No newline at end of file
+    return median_image
@@ -5,11 +5,33 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 import os, cv2, sys
 import numpy as np
 import pandas as pd
-from math import ceil, floor
-import dask_image.imread
+from functools import partial
+from skimage.io import imread
 from dask import delayed
+from dask.base import tokenize
 import dask.array as da
 from Preprocessing.preproc import beautify_frame
+from rankfilter import rolling_percentile, window_indexes
+from framecache import FrameCache
+from framestore import open_stores
+from imgio import read_image
+from resultcache import ResultCache
+from tracing import traced
+
+PREPROC_PARAMS = ('gray', 'beautify_frame') # Preprocessing applied to the frames, part of their FrameCache key
+
+_folder_indexes = {} # Folder -> (mtime, sorted jpg names, name -> index), rebuilt when the folder changes
+
+
+def _folder_index(folder):
+    '''Sorted names of the jpg images of a folder and their positions, listed once per folder (and again only if it changed).'''
+    mtime = os.stat(folder).st_mtime_ns
+    cached = _folder_indexes.get(folder)
+    if cached is None or cached[0] != mtime:
+        names = sorted(f for f in os.listdir(folder) if f.endswith('.jpg'))
+        cached = (mtime, names, {name: i for i, name in enumerate(names)})
+        _folder_indexes[folder] = cached
+    return cached[1], cached[2]
 
 
 # Converts an image to grayscale
@@ -19,13 +41,19 @@ def convert_gray_old(bgr): # 20min33
               (bgr[..., 2] * 0.299))
     return result
 
-@delayed
-def convert_gray(img): # 13min14
+def to_gray(img):
     np_img = np.array(img) # Convert from Dask array to numpy array
+    if np_img.ndim == 2: # Already grayscale (e.g. from a frame store)
+        return np_img
     return cv2.cvtColor(np_img, cv2.COLOR_BGR2GRAY)
 
+@delayed
+def convert_gray(img): # 13min14
+    return to_gray(img)
+
 # Function to apply filtering on a substack of images
 @delayed
+@traced(frames=lambda substack, *args, **kwargs: len(substack))
 def percentile_custom(substack, percentile=75):
     # Return the percentile across the specified axis
     return np.percentile(substack, percentile, axis=0).astype(np.uint8)
@@ -44,9 +72,17 @@ def beautify_frame_delayed(img):
     #img = np.array(img) # Convert from Dask array to numpy array
     return beautify_frame(img)
 
-def __filter_substack(images,i,filter_length,percentile,frame_skip=1):
-    # Get the substack
-    substack = images[max(0,i-frame_skip*floor(filter_length/2)):i + frame_skip*ceil(filter_length/2):frame_skip]
+@delayed
+def cached_frame(cache:FrameCache, path, read, params=PREPROC_PARAMS):
+    return cache.get_or_compute(path, params, read)
+
+def _preproc_params(read_scale):
+    # Frames decoded by imgio differ from the dask_image ones, so they are cached separately
+    return PREPROC_PARAMS if read_scale is None else PREPROC_PARAMS + ('imgio', read_scale)
+
+def __filter_substack(frames,n_images,i,filter_length,percentile,frame_skip=1):
+    # Get the substack (frames can be indexed by the images of the windows, and may hold only those)
+    substack = [frames[j] for j in window_indexes(i, n_images, filter_length, frame_skip)]
     # Convert the substack to grayscale
     substack_gray = [convert_gray(img) for img in substack]
     # Preprocess the substack
@@ -55,45 +91,103 @@ def __filter_substack(images,i,filter_length,percentile,frame_skip=1):
     percentile_img = percentile_custom(substack_gray, percentile)
     return percentile_img
 
-def __filter(images_folder,idxs:list,frame_skip=1,filter_length=40,percentile=75, annotate_names=False, verbose=False):
+def __filter_substack_cached(read_preprocessed,paths,n_images,i,filter_length,percentile,frame_skip,cache:FrameCache,params=PREPROC_PARAMS):
+    # One task per file, shared by all the windows containing it, that only reads the file on a cache miss
+    substack = [cached_frame(cache, paths[j], partial(read_preprocessed, j), params, dask_key_name='cached_frame-' + tokenize(paths[j], params))
+                for j in window_indexes(i, n_images, filter_length, frame_skip)]
+    return percentile_custom(substack, percentile)
+
+def __filter(images_folder,idxs:list,frame_skip=1,filter_length=40,percentile=75, annotate_names=False, streaming=False, cache:FrameCache=None, read_scale:float=None, iterate=False, batch_size=None, verbose=False):
     if verbose:
         print("Indexes: ", idxs)
         print("for images in folder: ", images_folder)
-    all_files = os.path.join(images_folder, '*.jpg')
-    try:
-        images = dask_image.imread.imread(all_files)
-    except Exception as e:
-        print(f"Error reading images from {all_files}: {e}")
-        raise e
-    img_names = [f for f in os.listdir(images_folder) if f.endswith('.jpg')]
-    img_names.sort()
-    img_names = [img_names[i] for i in idxs]
+    jpg_names, _ = _folder_index(images_folder)
+    n_images = len(jpg_names)
+    img_names = [jpg_names[i] for i in idxs]
+    # Only the images of the requested windows are read, whatever the size of the folder
+    needed = sorted(set(j for i in idxs for j in window_indexes(i, n_images, filter_length, frame_skip)))
+    jpg_paths = {j: os.path.join(images_folder, jpg_names[j]) for j in needed}
+    if read_scale is None:
+        read = traced('decode', path_arg=0)(imread) # RGB, as dask_image.imread
+    else:
+        read = partial(read_image, gray=True, scale=read_scale) # Decoded straight to grayscale, at read_scale
+    # One task per image, shared by all the windows containing it (the first image is read now, for the shape)
+    first = read(jpg_paths[needed[0]])
+    frames = {j: delayed(read)(jpg_paths[j], dask_key_name='read-' + tokenize(jpg_paths[j], read_scale)) for j in needed[1:]}
+    frames[needed[0]] = delayed(first, name='read-' + tokenize(jpg_paths[needed[0]], read_scale))
     if verbose:
-        print("Dask images: ", images)
+        print(f"{len(needed)} images read out of {n_images} in the folder")
+
+    def read_preprocessed(j):
+        img = frames[j].compute(scheduler='synchronous')
+        return beautify_frame(to_gray(img))
 
-    # Prepare all filenames
-    filenames = os.listdir(images_folder)
-    filenames.sort()
-    # Remove hidden files
-    filenames = [f for f in filenames if not f.startswith('.')]
+    filtered_imgs = __filter_images(frames, n_images, first.shape[:2], read_preprocessed, jpg_names, jpg_paths, idxs, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile,
+                                    annotate_names=annotate_names, streaming=streaming, cache=cache, preproc_params=_preproc_params(read_scale), iterate=iterate, batch_size=batch_size, verbose=verbose)
+    return filtered_imgs, img_names
 
-    # Read the first image to get the dimensions
-    first_image = cv2.imread(os.path.join(images_folder, filenames[0]))
-    height, width, _ = first_image.shape
+def __filter_images(frames, n_images, shape, read_preprocessed, names, paths, idxs:list, frame_skip=1, filter_length=40, percentile=75, annotate_names=False, streaming=False, cache:FrameCache=None, preproc_params=PREPROC_PARAMS, iterate=False, batch_size=None, verbose=False):
+    '''
+    Filters the images idxs of a sequence of n_images images of shape (H, W). frames[j] is the lazy (Dask array or Delayed) image j (for the images of the windows at least),
+    read_preprocessed(j) returns the preprocessed image j, names are the names of the n_images images and paths[j] the path of image j
+    (FrameCache keys with preproc_params, only used with a cache).
+    With iterate, returns a generator of the filtered images (np.ndarray) instead of a lazy stack: computed one at a time with streaming,
+    else by batches of batch_size images (default: filter_length), whose windows share their reads.
+    '''
+    if iterate and not streaming:
+        batch_size = batch_size or filter_length
+        return (img for start in range(0, len(idxs), batch_size)
+                for img in np.array(__filter_images(frames, n_images, shape, read_preprocessed, names, paths, idxs[start:start + batch_size], frame_skip=frame_skip,
+                                                    filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, cache=cache, preproc_params=preproc_params)))
+    height, width = shape
     if verbose:
         print("Image dimensions: ", height, width)
 
-    filtered_imgs = [__filter_substack(images, i,filter_length,percentile,frame_skip) for i in idxs]
+    if streaming:
+        # Computed right away: each image is read and preprocessed once, then kept in the rolling window while needed
+        if cache is not None:
+            load_image = lambda j: cache.get_or_compute(paths[j], preproc_params, partial(read_preprocessed, j))
+        else:
+            load_image = read_preprocessed
+        filtered_imgs = rolling_percentile(load_image, n_images, idxs, filter_length, percentile, frame_skip)
+        if iterate:
+            return (annotate_name(img, names[i]).compute() if annotate_names else img for i, img in zip(idxs, filtered_imgs))
+        filtered_imgs = [delayed(img) for img in filtered_imgs]
+    elif cache is not None:
+        filtered_imgs = [__filter_substack_cached(read_preprocessed, paths, n_images, i, filter_length, percentile, frame_skip, cache, preproc_params) for i in idxs]
+    else:
+        filtered_imgs = [__filter_substack(frames, n_images, i,filter_length,percentile,frame_skip) for i in idxs]
     # Annotate all images with their name
     if annotate_names:
-        filtered_imgs = [annotate_name(img, filenames[idx]) for idx, img in zip(idxs,filtered_imgs)]
+        filtered_imgs = [annotate_name(img, names[idx]) for idx, img in zip(idxs,filtered_imgs)]
     filtered_imgs = da.stack([da.from_delayed(d, shape=(height,width), dtype=np.uint8) for d in filtered_imgs], axis=0)
-    return filtered_imgs, img_names
+    return filtered_imgs
 
+def __filter_stores(store_root, hive_nb:int, rpi_num:int, img_paths:pd.Series, frame_skip=1, filter_length=40, percentile=75, annotate_names=False, streaming=False, iterate=False, batch_size=None, verbose=False):
+    # Stores of the days of the images, and of the days before and after for the windows overlapping midnight
+    timestamps = pd.DatetimeIndex(img_paths.index).tz_convert('UTC')
+    days = sorted(set((timestamps - pd.Timedelta(days=1)).strftime('%y%m%d')) | set(timestamps.strftime('%y%m%d')) | set((timestamps + pd.Timedelta(days=1)).strftime('%y%m%d')))
+    stores = open_stores(store_root, hive_nb, rpi_num, days)
+    if len(stores) == 0:
+        raise ValueError(f"No frame store for hive {hive_nb}, rpi {rpi_num} in {store_root}")
+    images = da.concatenate([store.to_dask() for store in stores], axis=0)
+    frames = [store[i] for store in stores for i in range(len(store))] # Memory-mapped views, no copy
+    names = [name for store in stores for name in store.names]
+    positions = {name: i for i, name in enumerate(names)}
+    idxs = [positions[os.path.basename(path)] for path in img_paths]
+    read_preprocessed = lambda j: beautify_frame(to_gray(frames[j]))
+    return __filter_images(images, len(images), images.shape[1:3], read_preprocessed, names, None, idxs, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile,
+                           annotate_names=annotate_names, streaming=streaming, iterate=iterate, batch_size=batch_size, verbose=verbose)
 
-def percentile_filter_df(img_paths:pd.DataFrame, frame_skip:int=1, filter_length:int=40, percentile:int=75, annotate_names:bool=False, verbose:bool=False):
+
+def percentile_filter_df(img_paths:pd.DataFrame, frame_skip:int=1, filter_length:int=40, percentile:int=75, annotate_names:bool=False, streaming:bool=False, cache:FrameCache=None, store_root:str=None, read_scale:float=None, verbose:bool=False):
     '''
     This function makes a percentile filter of images with paths contained in a dataframe. It is preprocessing images.
+    If streaming is True, the windows are computed with a rolling rank filter instead of one Dask stack per image (same output).
+    The rank filter holds a histogram of 256 x pixels bytes per RPi (~3 GB for a full resolution gray frame, 512 x pixels above 255 frames per window).
+    If a FrameCache is given (e.g. framecache.frame_cache), preprocessed frames are read from it and added to it.
+    If store_root is given, the frames are read from the frame stores materialized there (see framestore.materialize) instead of decoding the images.
+    If read_scale is given, the images are decoded straight to grayscale at that scale (see imgio.read_image) and the filtered images have that scale.
     
     :return filtered_imgs, imgs_names: A tuple with a dataframe with the filtered images with the same structure as the input dataframe and names.
     '''
@@ -109,17 +203,17 @@ def percentile_filter_df(img_paths:pd.DataFrame, frame_skip:int=1, filter_length
     for col in img_paths.columns:
         if col == 'valid':
             continue
+        if store_root is not None:
+            rpi_imgs = __filter_stores(store_root, int(col[1]), int(col[3]), img_paths[col], frame_skip=frame_skip, filter_length=filter_length, percentile=percentile,
+                                       annotate_names=annotate_names, streaming=streaming, verbose=verbose)
+            filtered_imgs[col] = list(np.array(rpi_imgs))
+            continue
         first_path = img_paths[col].iloc[0]
         folder = os.path.dirname(first_path)
-        files = sorted(os.listdir(folder))
-
-        # Remove hidden files (starting with .)
-        files = [f for f in files if not f.startswith('.')]
-        # Find the idx in files corresponding to all the images in img_paths[col]
-        idxs = []
-        for path in img_paths[col]:
-            idxs.append(files.index(os.path.basename(path)))
-        rpi_imgs, _ = __filter(folder, idxs, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, verbose=verbose)
+        # Find the idx in the folder of all the images in img_paths[col]
+        _, positions = _folder_index(folder)
+        idxs = [positions[os.path.basename(path)] for path in img_paths[col]]
+        rpi_imgs, _ = __filter(folder, idxs, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, streaming=streaming, cache=cache, read_scale=read_scale, verbose=verbose)
         rpi_imgs = np.array(rpi_imgs) # This computes the result
         filtered_imgs[col] = list(rpi_imgs)
 
@@ -129,27 +223,67 @@ def percentile_filter_df(img_paths:pd.DataFrame, frame_skip:int=1, filter_length
 
     return filtered_imgs, imgs_names
 
+def percentile_filter_iter(img_paths:pd.Series, frame_skip:int=1, filter_length:int=40, percentile:int=75, annotate_names:bool=False, streaming:bool=False, cache:FrameCache=None, store_root:str=None, read_scale:float=None, batch_size:int=None, verbose:bool=False):
+    '''
+    Same filter as percentile_filter_df for the images of one RPi (a column of a fetchImagesPaths() dataframe, e.g. img_paths['h1r2']),
+    as a generator yielding (datetime, name, filtered image) in the order of img_paths, so that the images can be written as they are computed
+    instead of being held in memory. With streaming, images are computed one at a time, else by batches of batch_size images (default: filter_length).
+    '''
+    img_paths = img_paths.dropna()
+    if len(img_paths) == 0:
+        return
+    names = img_paths.apply(lambda x: os.path.basename(x).split('.')[0])
+    if store_root is not None:
+        col = img_paths.name
+        filtered_imgs = __filter_stores(store_root, int(col[1]), int(col[3]), img_paths, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile,
+                                        annotate_names=annotate_names, streaming=streaming, iterate=True, batch_size=batch_size, verbose=verbose)
+    else:
+        folder = os.path.dirname(img_paths.iloc[0])
+        _, positions = _folder_index(folder)
+        idxs = [positions[os.path.basename(path)] for path in img_paths]
+        filtered_imgs, _ = __filter(folder, idxs, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, streaming=streaming,
+                                    cache=cache, read_scale=read_scale, iterate=True, batch_size=batch_size, verbose=verbose)
+    for dt, name, img in zip(img_paths.index, names, filtered_imgs):
+        yield dt, name, img
+
 
-def percentile_filter(images_folder,start_idx:int, stop_idx:int=None,step:int=1,frame_skip:int=1,filter_length:int=40,percentile:int=75, annotate_names:bool=False, verbose:bool=False):
+def percentile_filter(images_folder,start_idx:int, stop_idx:int=None,step:int=1,frame_skip:int=1,filter_length:int=40,percentile:int=75, annotate_names:bool=False, streaming:bool=False, cache:FrameCache=None, read_scale:float=None, verbose:bool=False):
     '''
     This function makes a percentile filter of images between start and stop indexes.  It is preprocessing images.
+    If streaming is True, each image is read and preprocessed once and the windows are updated incrementally (same output),
+    which is much faster for long windows and small steps. The result is then computed right away instead of lazily.
+    The rolling rank filter holds a histogram of 256 x pixels bytes (~3 GB for a full resolution gray frame, 512 x pixels above 255 frames per window).
+    If a FrameCache is given (e.g. framecache.frame_cache), preprocessed frames are read from it and added to it.
+    If read_scale is given, the images are decoded straight to grayscale at that scale (see imgio.read_image) and the filtered images have that scale.
     '''
     if stop_idx is None:
         stop_idx = start_idx + 1
     idxs = range(start_idx, stop_idx, step) # Images that need to be filtered
-    return __filter(images_folder, idxs, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, verbose=verbose)
+    return __filter(images_folder, idxs, frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, streaming=streaming, cache=cache, read_scale=read_scale, verbose=verbose)
 
-def percentile_filter_single(img_path:str,frame_skip:int=1,filter_length:int=40,percentile:int=75, annotate_names:bool=False, verbose:bool=False):
+def percentile_filter_single(img_path:str,frame_skip:int=1,filter_length:int=40,percentile:int=75, annotate_names:bool=False, cache:FrameCache=None, read_scale:float=None, result_cache:ResultCache=None, verbose:bool=False):
     '''
     This function makes a percentile filter of a single image rather than a substack. It is preprocessing images.
+    If read_scale is given, the images are decoded straight to grayscale at that scale (see imgio.read_image).
+    If a ResultCache is given, the filtered image is loaded from it if it was computed before with the same images and parameters,
+    else computed and stored in it (the image is then returned computed, as a np.ndarray).
     returns the filtered image and its name.
     '''
     parent_folder = os.path.dirname(img_path)
     image_file = os.path.basename(img_path)
-    all_files = [f for f in os.listdir(parent_folder) if f.endswith('.jpg')]
-    index = sorted(all_files).index(image_file)
-    img, img_name = __filter(parent_folder, [index], frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, verbose=verbose)
-    img = img[0]
-    img_name = img_name[0]
+    jpg_names, positions = _folder_index(parent_folder)
+    index = positions[image_file]
+    filter_single = lambda: __filter(parent_folder, [index], frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, annotate_names=annotate_names, cache=cache, read_scale=read_scale, verbose=verbose)[0][0]
+    if result_cache is None:
+        img = filter_single()
+    else:
+        window = window_indexes(index, len(jpg_names), filter_length, frame_skip)
+        window_paths = [os.path.join(parent_folder, jpg_names[j]) for j in window]
+        # Windows clipped at the ends of the folder can be the same for several images: the key also holds the resolved bounds,
+        # the file names and the filtered image, whose name is drawn with annotate_names
+        params = {'filter_length': filter_length, 'percentile': percentile, 'frame_skip': frame_skip, 'annotate_names': annotate_names, 'read_scale': read_scale,
+                  'window': [window.start, window.stop], 'files': [jpg_names[j] for j in window], 'image': image_file}
+        img = result_cache.get_or_compute(window_paths, 'percentile', params, filter_single)
+    img_name = image_file
 
     return img, img_name
\ No newline at end of file
@@ -0,0 +1,107 @@
+'''
+Season-scale percentile filtering: the images of fetchImagesPaths() dataframes are split into (hive, rpi, time chunk) work units,
+filtered on a pool of processes and written to disk one by one, as soon as each image is computed.
+The number of processes is bounded by a memory budget.
+
+Windows at the edges of a chunk are complete: percentile_filter_iter reads the frames of a window from the RPi folder (or frame store),
+so each chunk reads the filter_length halo frames around it by itself.
+'''
+
+import os
+import cv2
+import pandas as pd
+import dask
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from percentile import percentile_filter_iter
+
+
+def _filter_work_unit(hive_nb:int, col:str, chunk:pd.Series, out_dir:str, filter_kwargs:dict):
+    '''Filters one (hive, rpi, time chunk) work unit, writing each image as soon as it is computed. Runs in a worker process.'''
+    folder = os.path.join(str(out_dir), f"hive{hive_nb}", col)
+    os.makedirs(folder, exist_ok=True)
+    out_paths = pd.Series(None, index=chunk.index, dtype=object)
+    # Parallelism is across work units: Dask runs synchronously inside each worker
+    with dask.config.set(scheduler='synchronous'):
+        for dt, name, img in percentile_filter_iter(chunk.rename(col), **filter_kwargs):
+            out_path = os.path.join(folder, name + '.png')
+            cv2.imwrite(out_path, img)
+            out_paths[dt] = out_path
+    return hive_nb, col, out_paths
+
+
+def _total_ram_bytes() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _worker_bytes(n_pixels:int, filter_length:int, streaming:bool, batch_size:int) -> int:
+    '''
+    Approximate peak memory of a worker for frames of n_pixels pixels: with streaming, the histogram of the rolling filter
+    (256 or 512 bytes per pixel), the frames of a window and a decoded frame; else, the decoded (RGB), gray and preprocessed frames
+    of a batch of images and their windows, the percentile temporaries and the filtered images of the batch.
+    '''
+    if streaming:
+        return (256 * (1 if filter_length <= 255 else 2) + filter_length + 8) * n_pixels
+    return (5 * (batch_size + filter_length) + 16 + batch_size) * n_pixels
+
+
+def percentile_filter_season(imgs_paths:dict, out_dir:str, chunk_size:int=360, n_workers:int=None, max_ram_bytes:int=None, skip_existing:bool=True,
+                             frame_skip:int=1, filter_length:int=40, percentile:int=75, streaming:bool=True, store_root:str=None, verbose:bool=False) -> dict:
+    '''
+    Percentile filters the images of several hives on a pool of processes, writing each filtered image as a PNG in out_dir/hive<N>/<rpi>/.
+
+    :param imgs_paths: dict, hive number -> pd.DataFrame of images paths as returned by libimage.fetchImagesPaths().
+    :param out_dir: str, output directory.
+    :param chunk_size: int, number of consecutive images per work unit. Each unit also reads filter_length halo frames, so larger chunks read less twice.
+                       Images are written as they are computed, so the chunk size does not change the memory used by a worker.
+    :param n_workers: int, maximum number of processes. Default: number of CPUs. Fewer are used if their memory would exceed max_ram_bytes.
+    :param max_ram_bytes: int, memory budget of all the workers in bytes. Default: 3/4 of the physical memory.
+                          Without streaming, it also bounds the number of images computed at once by a worker (at most filter_length).
+    :param skip_existing: bool, if True, images whose output already exists are not recomputed (to resume an interrupted run).
+    :param streaming: bool, use the rolling percentile filter inside each work unit (see percentile_filter_df).
+    :param store_root: str, if given, the frames are read from the frame stores there (see percentile_filter_df).
+    :return out_paths: dict, hive number -> pd.DataFrame of the output paths, with the same index and RPi columns as the input.
+    '''
+    out_paths = {}
+    work_units = []
+    for hive_nb, df in imgs_paths.items():
+        rpi_cols = [col for col in df.columns if col != 'valid']
+        out_paths[hive_nb] = pd.DataFrame(None, index=df.index, columns=rpi_cols, dtype=object)
+        for col in rpi_cols:
+            paths = df[col].dropna()
+            if skip_existing:
+                existing = paths.apply(lambda p: os.path.join(str(out_dir), f"hive{hive_nb}", col, os.path.basename(p).split('.')[0] + '.png'))
+                done = existing.apply(os.path.exists)
+                out_paths[hive_nb].loc[existing[done].index, col] = existing[done]
+                paths = paths[~done]
+            for start in range(0, len(paths), chunk_size):
+                work_units.append((hive_nb, col, paths.iloc[start:start + chunk_size]))
+    if len(work_units) == 0:
+        return out_paths
+
+    # Workers and images per batch within the memory budget, from the size of the frames
+    first = cv2.imread(str(work_units[0][2].iloc[0]), cv2.IMREAD_GRAYSCALE)
+    if first is None:
+        raise ValueError(f"Could not read {work_units[0][2].iloc[0]}")
+    n_pixels = first.size
+    max_ram_bytes = max_ram_bytes or _total_ram_bytes() * 3 // 4
+    n_workers = min(n_workers or os.cpu_count(), len(work_units))
+    batch_size = filter_length
+    if not streaming:
+        while batch_size > 1 and _worker_bytes(n_pixels, filter_length, streaming, batch_size) > max_ram_bytes:
+            batch_size //= 2
+    worker_bytes = _worker_bytes(n_pixels, filter_length, streaming, batch_size)
+    if worker_bytes > max_ram_bytes:
+        print(f"[W]: a worker needs ~{worker_bytes / 2**30:.1f} GB, more than max_ram_bytes ({max_ram_bytes / 2**30:.1f} GB). Running one worker.")
+    n_workers = max(1, min(n_workers, max_ram_bytes // worker_bytes))
+    filter_kwargs = dict(frame_skip=frame_skip, filter_length=filter_length, percentile=percentile, streaming=streaming, store_root=store_root, batch_size=batch_size)
+    if verbose:
+        print(f"{len(work_units)} work units of up to {chunk_size} images, {n_workers} workers of ~{worker_bytes / 2**30:.1f} GB")
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_filter_work_unit, hive_nb, col, chunk, out_dir, filter_kwargs) for hive_nb, col, chunk in work_units]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Filtering", unit="chunk"):
+            hive_nb, col, chunk_paths = future.result()
+            out_paths[hive_nb].loc[chunk_paths.index, col] = chunk_paths
+
+    return out_paths
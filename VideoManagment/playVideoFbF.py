@@ -1,37 +1,147 @@
 '''
 This script plays a video frame by frame from an .mp4 (or other) video file.
+Keys: 'k' next frame, 'j' previous frame, 'q' quit.
+
+FramePlayer can also be used on its own for random access to the frames of a video: decoded frames around the current
+position are kept in a bounded buffer and the next ones are decoded ahead on a background thread, so that stepping
+forwards or backwards does not seek and decode from the previous keyframe for every frame.
 '''
 
 import cv2
+import threading
 
 video_path = '/Users/cyrilmonette/Desktop/EPFL 2018-2026/PhD - Mobots/data/22.12-23.02_actuation_OH/Images/high-fps/h5r2_22.12/hive5_rpi2_day-221228.mp4'
 
 
+class FramePlayer:
+    '''
+    Random access to the frames of a video, with a buffer of decoded frames around the cursor and forward prefetching.
+    A frame outside the buffer costs one seek: going backwards, the frames before it are decoded as well (back_fill),
+    so that the next backward steps are in the buffer too.
+    '''
+
+    def __init__(self, video_path:str, buffer_size:int=256, prefetch:int=32, back_fill:int=64):
+        '''
+        :param video_path: str, path to the video.
+        :param buffer_size: int, maximum number of decoded frames kept (memory: buffer_size frames).
+        :param prefetch: int, number of frames decoded ahead of the cursor.
+        :param back_fill: int, number of frames decoded before a frame reached backwards outside the buffer.
+        '''
+        if buffer_size <= prefetch + back_fill:
+            raise ValueError("buffer_size must be larger than prefetch + back_fill")
+        self._cap = cv2.VideoCapture(str(video_path))
+        if not self._cap.isOpened():
+            raise ValueError(f"Could not open video {video_path}")
+        self.fps = self._cap.get(cv2.CAP_PROP_FPS)
+        # Frame count from the container, corrected if the decoder ends earlier
+        self._n_frames = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.buffer_size, self.prefetch, self.back_fill = buffer_size, prefetch, back_fill
+        self._frames = {} # Frame index -> decoded frame
+        self._cursor = 0
+        self._decode_pos = 0 # Index of the frame the capture reads next
+        self._seek_to = None
+        self._stop = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._decode_loop, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self._n_frames
+
+    @property
+    def position(self) -> int:
+        return self._cursor
+
+    def _wants_decode(self):
+        return self._decode_pos < self._n_frames and self._decode_pos <= self._cursor + self.prefetch
+
+    def _decode_loop(self):
+        while True:
+            with self._cond:
+                while not self._stop and self._seek_to is None and not self._wants_decode():
+                    self._cond.wait()
+                if self._stop:
+                    return
+                seek, pos = self._seek_to is not None, self._seek_to if self._seek_to is not None else self._decode_pos
+                self._seek_to = None
+            # The capture is only used by this thread, outside the lock
+            if seek:
+                self._cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
+            ok, frame = self._cap.read()
+            with self._cond:
+                if ok:
+                    self._frames[pos] = frame
+                    self._decode_pos = pos + 1
+                    self._evict()
+                else:
+                    self._n_frames = pos # End of the video
+                    self._decode_pos = pos
+                self._cond.notify_all()
+
+    def _evict(self):
+        # Drop the frames farthest from the cursor
+        while len(self._frames) > self.buffer_size:
+            del self._frames[max(self._frames, key=lambda i: abs(i - self._cursor))]
+
+    def get(self, i:int):
+        '''Returns frame i and moves the cursor to it. Raises IndexError past the end of the video.'''
+        with self._cond:
+            if not 0 <= i < self._n_frames:
+                raise IndexError(f"Frame {i} out of range for a video of {self._n_frames} frames")
+            backwards = i < self._cursor
+            self._cursor = i
+            if i not in self._frames and not (self._decode_pos <= i <= self._decode_pos + self.prefetch and not backwards):
+                # Not buffered nor about to be decoded: seek (before it if going backwards)
+                self._seek_to = max(0, i - self.back_fill) if backwards else i
+            self._cond.notify_all()
+            while i not in self._frames:
+                if i >= self._n_frames:
+                    raise IndexError(f"Frame {i} out of range for a video of {self._n_frames} frames")
+                self._cond.wait()
+            return self._frames[i]
+
+    def __getitem__(self, i:int):
+        return self.get(i)
+
+    def step(self, delta:int=1):
+        '''Moves the cursor by delta frames (clipped to the video) and returns the frame there.'''
+        return self.get(min(max(0, self._cursor + delta), self._n_frames - 1))
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._cap.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def play_video(video_path):
-    # load video capture from file
-    video = cv2.VideoCapture(video_path)
-    # window name and size
-    cv2.namedWindow("video", cv2.WINDOW_AUTOSIZE)
-    while video.isOpened():
-        # Read video capture
-        ret, frame = video.read()
-        # Display each frame
-        cv2.imshow("video", frame)
-        # show one frame at a time
-        key = cv2.waitKey(0)
-        while key not in [ord('q'), ord('k')]:
+    with FramePlayer(video_path) as player:
+        # window name and size
+        cv2.namedWindow("video", cv2.WINDOW_AUTOSIZE)
+        frame = player.get(0)
+        while True:
+            # Display the current frame
+            cv2.imshow("video", frame)
+            # show one frame at a time
             key = cv2.waitKey(0)
-        # Quit when 'q' is pressed
-        if key == ord('q'):
-            break
-        if key==ord('j'):
-            # Go back one frame
-            video.set(cv2.CAP_PROP_POS_FRAMES, video.get(cv2.CAP_PROP_POS_FRAMES) - 2)
-            
-    # Release capture object
-    video.release()
+            while key not in [ord('q'), ord('k'), ord('j')]:
+                key = cv2.waitKey(0)
+            # Quit when 'q' is pressed
+            if key == ord('q'):
+                break
+            # Next frame with 'k', previous frame with 'j'
+            frame = player.step(1 if key == ord('k') else -1)
+
     # Exit and distroy all windows
     cv2.destroyAllWindows()
 
 
-play_video(video_path)
\ No newline at end of file
+if __name__ == "__main__":
+    play_video(video_path)
@@ -1,8 +1,10 @@
-import cv2, os
+import cv2, os, time, threading, queue
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
 from libimage import RPiCamV3_img_shape, RPiCamV3_img_shape_RGB
+from imgio import read_image, decode_scale
+import tracing
 
 
 def fig_to_rgb_array(fig, rgb=False):
@@ -59,7 +61,7 @@ def generateVideoFromDir():
 
 def generateVideoFromList(imgs:list, dest, name:str="video", fps:int=10, grayscale:bool=True):
     '''
-    This function generates a video from a list of images.
+    This function generates a video from a list of images, or any sequence of frames supporting len() and indexing (e.g. a framestore.FrameStore, read without copies).
     '''
     # Checks on the inputs
     if not os.path.isdir(dest):
@@ -82,7 +84,8 @@ def generateVideoFromList(imgs:list, dest, name:str="video", fps:int=10, graysca
 
     # Iterate over the frames and write each one to the video
     for frame in tqdm(imgs, desc="Writing video", unit="frame"):
-        video.write(frame)
+        with tracing.span('video_encode', frames=1, nbytes=frame.nbytes):
+            video.write(frame)
 
     # Release the VideoWriter object
     video.release()
@@ -116,6 +119,107 @@ def initVideoWriter(dest, shape, name:str="video",fps:int=10):
     video = cv2.VideoWriter(name, fourcc, fps, size, isColor = not grayscale)
     return video
 
+class StreamingVideoWriter:
+    '''
+    VideoWriter (see initVideoWriter) encoding frames on a background thread. write() puts frames in a bounded queue
+    and only blocks when the queue is full, so that producing the frames overlaps with encoding them.
+    Use as a context manager, or call close() to wait for the last frames and release the video.
+    '''
+    def __init__(self, dest, shape, name:str="video", fps:int=10, queue_size:int=16):
+        '''
+        :param dest: str, destination directory to save the video.
+        :param shape: tuple, shape of the frames (height, width) or (height, width, channels).
+        :param name: str, name of the video file (without extension).
+        :param fps: int, frames per second for the video.
+        :param queue_size: int, maximum number of frames waiting to be encoded (memory bound: queue_size frames).
+        '''
+        self.shape = tuple(shape)
+        self._video = initVideoWriter(dest, shape, name=name, fps=fps)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self.frames_written = 0
+        self.max_queue_depth = 0
+        self.encode_time = 0.0
+        self._start_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._encode, daemon=True)
+        self._thread.start()
+
+    def _encode(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            if self._error is not None:
+                continue # Keep draining the queue so that write() never blocks
+            try:
+                t0 = time.perf_counter()
+                with tracing.span('video_encode', frames=1, nbytes=frame.nbytes):
+                    self._video.write(frame)
+                self.encode_time += time.perf_counter() - t0
+                self.frames_written += 1
+            except Exception as e:
+                self._error = e
+
+    def write(self, frame):
+        if self._error is not None:
+            raise RuntimeError("Video encoding failed") from self._error
+        if frame.shape != self.shape:
+            raise ValueError(f"frame has shape {frame.shape}, expected {self.shape}")
+        with tracing.span('video_queue_put', frames=1): # Time blocked on a full queue
+            self._queue.put(frame)
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._video.release()
+        if self._error is not None:
+            raise RuntimeError("Video encoding failed") from self._error
+
+    def stats(self) -> dict:
+        '''Returns the number of frames written, the overall and encoding-only frames/sec, and the current and maximum queue depths.'''
+        elapsed = time.perf_counter() - self._start_time
+        return {'frames_written': self.frames_written,
+                'fps': self.frames_written / elapsed if elapsed > 0 else 0.0,
+                'encode_fps': self.frames_written / self.encode_time if self.encode_time > 0 else 0.0,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_queue_depth}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def generateVideoFromIterator(frames, dest, name:str="video", fps:int=10, queue_size:int=16, total:int=None, verbose:bool=False):
+    '''
+    Generates a video from an iterator (e.g. a generator) of frames, encoding on a background thread while the next frames are produced.
+    Unlike generateVideoFromList, frames are never all in memory. The frame shape (and grayscale or not) is taken from the first frame.
+
+    :param frames: iterable of frames (np.ndarray), all of the same shape.
+    :param dest: str, destination directory to save the video. Created if needed.
+    :param queue_size: int, maximum number of frames waiting to be encoded.
+    :param total: int, optional number of frames, for the progress bar.
+    :return stats: dict, see StreamingVideoWriter.stats().
+    '''
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    frames = iter(frames)
+    try:
+        first = next(frames)
+    except StopIteration:
+        raise ValueError("frames must not be empty")
+
+    with StreamingVideoWriter(dest, first.shape, name=name, fps=fps, queue_size=queue_size) as writer:
+        writer.write(first)
+        for frame in tqdm(frames, desc="Writing video", unit="frame", initial=1, total=total):
+            writer.write(frame)
+    stats = writer.stats()
+    if verbose:
+        print(f"{stats['frames_written']} frames written at {stats['fps']:.1f} fps (encoding alone: {stats['encode_fps']:.1f} fps), max queue depth {stats['max_queue_depth']}")
+    return stats
+
 def imageHiveOverview(imgs: list, rgb: bool = False, img_names: list[str]= None, dt: pd.Timestamp = None, valid: bool = True):
     '''
     Generates a global image with the 4 images of the hives. If provided, also adds the img_names on the pictures.
@@ -143,6 +247,10 @@ def imageHiveOverview(imgs: list, rgb: bool = False, img_names: list[str]= None,
     # Resize the image to 4K
     img = cv2.resize(img, (3840, 2160), interpolation=cv2.INTER_LINEAR)
 
+    return _decorateOverview(img, rgb, dt, valid)
+
+def _decorateOverview(img, rgb: bool, dt: pd.Timestamp, valid: bool):
+    '''Adds the timestamp and the invalid marking to a 4K hive overview.'''
     if dt is not None:
         # Make sure it is tz-aware
         assert dt.tzinfo is not None, "dt must be tz-aware"
@@ -170,4 +278,75 @@ def imageHiveOverview(imgs: list, rgb: bool = False, img_names: list[str]= None,
         cv2.putText(img, "Invalid dt", (1500, 500), cv2.FONT_HERSHEY_SIMPLEX, 6, red_color, 15, cv2.LINE_AA)
         cv2.putText(img, "Invalid dt", (1500, 1600), cv2.FONT_HERSHEY_SIMPLEX, 6, red_color, 15, cv2.LINE_AA)
 
-    return img
\ No newline at end of file
+    return img
+
+class HiveOverviewCompositor:
+    '''
+    Faster imageHiveOverview: each of the 4 images is resized straight into its quadrant of a preallocated 4K buffer,
+    without building the full resolution mosaic, and the names are drawn at output resolution (the inputs are not modified).
+    The layout is the same as imageHiveOverview. The buffer is reused across calls, e.g. over the datetimes of a video.
+    '''
+    OUT_SIZE = (3840, 2160) # Width, height
+
+    def __init__(self, rgb: bool = False):
+        '''
+        :param rgb: bool, if True, the input images are in RGB format, else BGR format.
+        '''
+        self.rgb = rgb
+        self._buffers = {} # Number of channels -> 4K buffer
+
+    def _buffer(self, channels: int):
+        if channels not in self._buffers:
+            width, height = self.OUT_SIZE
+            shape = (height, width) if channels == 1 else (height, width, channels)
+            self._buffers[channels] = np.zeros(shape, dtype=np.uint8)
+        return self._buffers[channels]
+
+    def compose(self, imgs: list, img_names: list[str] = None, dt: pd.Timestamp = None, valid: bool = True, copy: bool = True):
+        '''
+        Generates the overview of the 4 images (None for a missing image), see imageHiveOverview for the parameters.
+        If copy is False, the returned image is the internal buffer, overwritten by the next call:
+        use it only if it is consumed before (e.g. cv2.imshow, or a video writer without a background queue).
+        '''
+        available = [img for img in imgs if img is not None]
+        if len(available) > 0:
+            in_height, in_width = available[0].shape[:2]
+            channels = 1 if available[0].ndim == 2 else available[0].shape[2]
+        else:
+            in_height, in_width = RPiCamV3_img_shape
+            channels = 3 if self.rgb else 1
+        out = self._buffer(channels)
+        width, height = self.OUT_SIZE
+        q_width, q_height = width // 2, height // 2
+        # Frame 1 and 3 on top, frame 2 and 4 on bottom
+        corners = [(0, 0), (0, q_height), (q_width, 0), (q_width, q_height)]
+        for img, (x0, y0) in zip(imgs, corners):
+            quadrant = out[y0:y0 + q_height, x0:x0 + q_width]
+            if img is None:
+                quadrant[...] = 0
+            else:
+                cv2.resize(img, (q_width, q_height), dst=quadrant, interpolation=cv2.INTER_LINEAR)
+
+        if img_names is not None:
+            # Same position and size as the names written on the full resolution images
+            fx, fy = q_width / in_width, q_height / in_height
+            for name, (x0, y0) in zip(img_names, corners):
+                cv2.putText(out, name, (x0 + round(100 * fx), y0 + round(80 * fy)), cv2.FONT_HERSHEY_SIMPLEX, 2 * fx,
+                            (255, 255, 255), max(1, round(3 * fx)), cv2.LINE_AA)
+
+        img = _decorateOverview(out, self.rgb, dt, valid)
+        if copy and img is out:
+            img = out.copy()
+        return img
+
+    def compose_paths(self, paths: list, img_names: list[str] = None, dt: pd.Timestamp = None, valid: bool = True, gray: bool = False, copy: bool = True):
+        '''
+        Same as compose, from the paths of the 4 images (None for a missing image). Each image is decoded at the smallest
+        DCT scale (1/2 for RPiCamV3 frames) that still covers its quadrant, and straight to grayscale if gray is True.
+        '''
+        width, height = self.OUT_SIZE
+        scale = decode_scale(RPiCamV3_img_shape, (width // 2, height // 2))
+        imgs = [None if path is None else read_image(path, gray=gray, scale=scale) for path in paths]
+        if self.rgb:
+            imgs = [img if img is None or img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in imgs]
+        return self.compose(imgs, img_names=img_names, dt=dt, valid=valid, copy=copy)
@@ -0,0 +1,84 @@
+'''
+Activity tracking over image sequences: the biggest active area (optical flow) of each consecutive frame pair,
+as time-series that can be produced for a whole season in one pass.
+
+Each frame is decoded and converted to gray once and serves as the "current" frame of one pair and the "prev" frame of the next.
+The flow of the previous pair is used as initial estimate of the next one (OpenCV does not expose the Farneback pyramids
+for reuse, so the warm start is what is shared between pairs).
+'''
+
+import os
+import cv2 as cv
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from imutils import compute_dense_optical_flow, find_biggest_active_area
+
+ACTIVITY_COLUMNS = ['rpi', 'name', 'cx', 'cy', 'area', 'contour']
+
+
+def _read_gray(path):
+    return cv.imread(path, cv.IMREAD_GRAYSCALE)
+
+
+def track_activity(paths, scale:float=1.0, roi:tuple=None, warm_start:bool=True, read=None, verbose:bool=False):
+    '''
+    Generator yielding the biggest active area between each frame and the previous one, as (datetime, record) tuples.
+    The record is a dict with the image name, the centroid (cx, cy), the area and the contour of the active area
+    (NaN centroid, area 0 and None contour when there is no active area). Unreadable frames are skipped.
+
+    :param paths: pd.Series of images paths indexed by datetime (e.g. a column of libimage.fetchImagesPaths()), or an iterable of paths.
+    :param scale: float, scale at which the optical flow is computed (see imutils.compute_dense_optical_flow).
+    :param roi: tuple, (top, bottom, left, right) region where the flow is computed, e.g. from imutils.board_roi().
+    :param warm_start: bool, use the flow of the previous pair as initial estimate.
+    :param read: callable, read(path) returns the grayscale frame. Default: cv.imread in grayscale.
+    '''
+    if read is None:
+        read = _read_gray
+    items = paths.dropna().items() if isinstance(paths, pd.Series) else enumerate(paths)
+    prev, flow = None, None
+    for dt, path in items:
+        img = read(path)
+        if img is None:
+            print(f"[W]: Could not read {path}, skipped.")
+            continue
+        if prev is None or prev.shape != img.shape:
+            prev, flow = img, None
+            continue
+        flow, mag, _ = compute_dense_optical_flow(prev, img, scale=scale, roi=roi, magnitude_only=True,
+                                                  init_flow=flow if warm_start else None)
+        record = {'name': os.path.basename(path), 'cx': np.nan, 'cy': np.nan, 'area': 0.0, 'contour': None}
+        try:
+            (cx, cy), contour, area = find_biggest_active_area(mag)
+            record.update(cx=cx, cy=cy, area=float(area), contour=contour)
+        except (ValueError, ZeroDivisionError): # No active area, or a degenerate one
+            pass
+        if verbose:
+            print(f"{dt}: area {record['area']:.0f} at ({record['cx']}, {record['cy']})")
+        prev = img
+        yield dt, record
+
+
+def activity_df(img_paths:pd.DataFrame, n_threads:int=None, parquet_path:str=None, **kwargs) -> pd.DataFrame:
+    '''
+    Activity time-series of all the RPis of a fetchImagesPaths() dataframe, one RPi per thread (OpenCV releases the GIL).
+
+    :param img_paths: pd.DataFrame, images paths, indexed by datetime, with one column per RPi (e.g. 'h1r2').
+    :param n_threads: int, number of threads. Default: one per RPi.
+    :param parquet_path: str, if given, the dataframe is also written there as Parquet (requires pyarrow or fastparquet),
+                         with the contours as lists of [x, y] points.
+    :param kwargs: passed to track_activity() (scale, roi, warm_start, read).
+    :return df: pd.DataFrame indexed by datetime, with columns rpi, name, cx, cy, area and contour, sorted by datetime and RPi.
+    '''
+    rpi_cols = [col for col in img_paths.columns if col != 'valid']
+    with ThreadPoolExecutor(max_workers=n_threads or max(1, len(rpi_cols))) as pool:
+        results = pool.map(lambda col: [(dt, dict(record, rpi=col)) for dt, record in track_activity(img_paths[col], **kwargs)], rpi_cols)
+        rows = [row for col_rows in results for row in col_rows]
+
+    df = pd.DataFrame([record for _, record in rows], index=pd.Index([dt for dt, _ in rows], name='datetime'), columns=ACTIVITY_COLUMNS)
+    df = df.sort_values('rpi', kind='stable').sort_index(kind='stable')
+    if parquet_path is not None:
+        out = df.copy()
+        out['contour'] = out['contour'].apply(lambda c: None if c is None else c.reshape(-1, 2).tolist())
+        out.to_parquet(parquet_path)
+    return df
@@ -0,0 +1,306 @@
+'''
+Benchmarks of the imaging hot paths on synthetic RPiCamV3-like IR frames.
+
+Generates a folder of synthetic frames per RPi (same naming as the real captures), then times each benchmark in its own
+process so that the peak RSS is per benchmark. Results (throughput, peak RSS and per-stage breakdown) are written as JSON,
+to compare runs over time.
+
+Usage (from the repository root):
+    python benchmarks/bench_imaging.py --out bench.json
+    python benchmarks/bench_imaging.py --frames 20 --scale 0.25 --only beautify_frame_preproc median_filter
+'''
+
+import os, sys, json, time, argparse, platform, resource, tempfile, traceback
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for _p in [ROOT, os.path.join(ROOT, 'ForegroundRemoval', 'PercentileFilter'), os.path.join(ROOT, 'ForegroundRemoval', 'MedianFilter'),
+           os.path.join(ROOT, 'VideoManagment'), os.path.join(ROOT, 'CellContentIdentification')]:
+    if _p not in sys.path:
+        sys.path.append(_p)
+
+import cv2
+import numpy as np
+import pandas as pd
+from libimage import RPiCamV3_img_shape
+
+HIVE_NB = 1
+RPIS = [1, 2, 3, 4]
+FIRST_DT = pd.Timestamp('2024-09-13 12:00', tz='UTC')
+
+
+class Stages:
+    '''Accumulates the wall time spent in named stages.'''
+    def __init__(self):
+        self.times = {}
+
+    @contextmanager
+    def __call__(self, name):
+        t0 = time.perf_counter()
+        yield
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - t0
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def generate_frames(workdir:str, n_frames:int, shape:tuple, seed:int=0) -> dict:
+    '''
+    Writes n_frames synthetic IR-like JPEGs per RPi in workdir/h<hive>r<rpi>_synthetic, one per minute from FIRST_DT:
+    a smooth comb-like texture with noise and a few bright blobs ("bees") moving between frames.
+    Also writes a background for find_cluster_contour in workdir/background/. Returns the folder of each RPi.
+    '''
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    comb = 90 + 40 * np.sin(xx / (0.004 * width)) * np.cos(yy / (0.006 * height)) + 30 * (yy / height)
+    folders = {}
+    for rpi in RPIS:
+        folder = os.path.join(workdir, f"h{HIVE_NB}r{rpi}_synthetic")
+        folders[rpi] = folder
+        os.makedirs(folder, exist_ok=True)
+        blobs = rng.uniform(0, 1, (12, 2)) * (width, height)
+        for i in range(n_frames):
+            path = os.path.join(folder, f"hive{HIVE_NB}_rpi{rpi}_{(FIRST_DT + pd.Timedelta(minutes=i)).strftime('%y%m%d-%H%M')}01Z.jpg")
+            if os.path.exists(path):
+                continue
+            frame = comb + rng.normal(0, 8, shape).astype(np.float32)
+            blobs += rng.normal(0, 0.01 * width, blobs.shape)
+            for bx, by in blobs:
+                cv2.circle(frame, (int(bx) % width, int(by) % height), int(0.01 * width), 230, -1)
+            frame = cv2.cvtColor(np.clip(frame, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+            cv2.imwrite(path, frame)
+    bg_dir = os.path.join(workdir, 'background')
+    os.makedirs(bg_dir, exist_ok=True)
+    for rpi in RPIS:
+        bg_path = os.path.join(bg_dir, f"final_background_rpi{rpi}.jpg")
+        if not os.path.exists(bg_path):
+            cv2.imwrite(bg_path, cv2.cvtColor(np.clip(comb, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR))
+    return folders
+
+
+def _frame_paths(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.jpg'))
+
+
+def _read_gray(path):
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+
+
+# Each benchmark returns (number of frames processed, stage times)
+
+def bench_beautify_frame_preproc(ctx):
+    from Preprocessing.preproc import beautify_frame
+    stages = Stages()
+    paths = _frame_paths(ctx['folders'][1])
+    for path in paths:
+        with stages('decode'):
+            img = cv2.imread(path)
+        with stages('gray'):
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        with stages('beautify'):
+            beautify_frame(img)
+    return len(paths), stages.times
+
+def bench_beautify_frame_imutils(ctx):
+    import imutils
+    stages = Stages()
+    paths = _frame_paths(ctx['folders'][2])
+    for path in paths:
+        with stages('decode'):
+            img = _read_gray(path)
+        with stages('undistort'):
+            img = imutils._undistort_fused(img, 'rpi2')
+        with stages('unsharp'):
+            img = imutils._unsharp_mask(img, amount=1.5)
+        with stages('equalize'):
+            cv2.equalizeHist(img)
+    return len(paths), stages.times
+
+def bench_beautify_batch(ctx):
+    import imutils
+    paths = _frame_paths(ctx['folders'][2])
+    _, timings = imutils.beautify_batch(paths, 'rpi2')
+    timings.pop('wall')
+    return len(paths), timings
+
+def _bench_percentile(ctx, streaming):
+    from percentile import percentile_filter
+    stages = Stages()
+    n = len(_frame_paths(ctx['folders'][1]))
+    with stages('graph'):
+        imgs, _ = percentile_filter(ctx['folders'][1], 0, n, filter_length=ctx['filter_length'], streaming=streaming)
+    with stages('compute'):
+        np.array(imgs)
+    return n, stages.times
+
+def bench_percentile_filter(ctx):
+    return _bench_percentile(ctx, streaming=False)
+
+def bench_percentile_filter_streaming(ctx):
+    return _bench_percentile(ctx, streaming=True)
+
+def _bench_median(ctx, **kwargs):
+    from median_image import median_filter
+    stages = Stages()
+    paths = _frame_paths(ctx['folders'][1])
+    with stages('median'):
+        median_filter(paths, paths=True, **kwargs)
+    return len(paths), stages.times
+
+def bench_median_filter(ctx):
+    return _bench_median(ctx)
+
+def bench_median_filter_tiled(ctx):
+    return _bench_median(ctx, tiled=True, max_ram_bytes=2**30)
+
+def bench_find_cluster_contour(ctx):
+    import imutils
+    stages = Stages()
+    paths = _frame_paths(ctx['folders'][2])
+    with stages('load_bg_img'):
+        bg = imutils.load_bg_img(ctx['bg_dir'] + os.sep)
+    for path in paths:
+        with stages('decode'):
+            img = _read_gray(path)
+        with stages('find_cluster_contour'):
+            imutils.find_cluster_contour(img, bg)
+    return len(paths), stages.times
+
+def bench_compute_dense_optical_flow(ctx):
+    import imutils
+    stages = Stages()
+    paths = _frame_paths(ctx['folders'][3])
+    with stages('decode'):
+        prev = _read_gray(paths[0])
+    for path in paths[1:]:
+        with stages('decode'):
+            img = _read_gray(path)
+        with stages('optical_flow'):
+            _, mag, _ = imutils.compute_dense_optical_flow(prev, img)
+        with stages('find_biggest_active_area'):
+            try:
+                imutils.find_biggest_active_area(mag)
+            except ValueError: # No active area
+                pass
+        prev = img
+    return len(paths) - 1, stages.times
+
+def bench_region_growing(ctx):
+    from cellcontent import region_growing
+    stages = Stages()
+    paths = _frame_paths(ctx['folders'][4])[:3]
+    for path in paths:
+        with stages('decode'):
+            img = _read_gray(path)
+        with stages('region_growing'):
+            region_growing(img)
+    return len(paths), stages.times
+
+def bench_imageHiveOverview(ctx):
+    from videolib import imageHiveOverview
+    stages = Stages()
+    paths = [_frame_paths(ctx['folders'][rpi]) for rpi in RPIS]
+    n = min(len(p) for p in paths)
+    for i in range(n):
+        with stages('decode'):
+            imgs = [cv2.imread(p[i]) for p in paths]
+        with stages('overview'):
+            imageHiveOverview(imgs, img_names=[os.path.basename(p[i]) for p in paths], dt=FIRST_DT)
+    return n, stages.times
+
+def bench_HiveOverviewCompositor(ctx):
+    from videolib import HiveOverviewCompositor
+    stages = Stages()
+    compositor = HiveOverviewCompositor()
+    paths = [_frame_paths(ctx['folders'][rpi]) for rpi in RPIS]
+    n = min(len(p) for p in paths)
+    for i in range(n):
+        with stages('decode'):
+            imgs = [cv2.imread(p[i]) for p in paths]
+        with stages('overview'):
+            compositor.compose(imgs, img_names=[os.path.basename(p[i]) for p in paths], dt=FIRST_DT, copy=False)
+    return n, stages.times
+
+def _bench_fetch(ctx, use_catalog):
+    from libimage import fetchImagesPaths
+    stages = Stages()
+    datetimes = list(pd.date_range(FIRST_DT, periods=ctx['n_frames'], freq='min'))
+    with stages('fetch'):
+        fetchImagesPaths(ctx['workdir'], datetimes, HIVE_NB, use_catalog=use_catalog)
+    with stages('fetch_again'):
+        fetchImagesPaths(ctx['workdir'], datetimes, HIVE_NB, use_catalog=use_catalog)
+    return 2 * len(datetimes), stages.times
+
+def bench_fetchImagesPaths(ctx):
+    return _bench_fetch(ctx, use_catalog=False)
+
+def bench_fetchImagesPaths_catalog(ctx):
+    return _bench_fetch(ctx, use_catalog=True)
+
+
+BENCHMARKS = {name[len('bench_'):]: f for name, f in list(globals().items()) if name.startswith('bench_') and callable(f)}
+
+
+def _run_one(name, ctx):
+    '''Runs a benchmark in the current (fresh) process and returns its result.'''
+    t0 = time.perf_counter()
+    try:
+        frames, stages = BENCHMARKS[name](ctx)
+    except Exception:
+        return {'error': traceback.format_exc()}
+    seconds = time.perf_counter() - t0
+    # Throughput over the timed stages only, the total also includes the imports
+    busy = sum(stages.values())
+    return {'seconds': seconds, 'frames': frames, 'frames_per_s': frames / busy if busy > 0 else None,
+            'peak_rss_mb': _peak_rss_mb(), 'stages': stages}
+
+
+def run_benchmarks(workdir:str, n_frames:int=20, scale:float=1.0, filter_length:int=10, only:list=None, verbose:bool=True) -> dict:
+    '''
+    Generates the synthetic frames (if not already in workdir) and runs the benchmarks, each in its own process.
+    :return results: dict, with the run metadata and one entry per benchmark.
+    '''
+    shape = (int(RPiCamV3_img_shape[0] * scale), int(RPiCamV3_img_shape[1] * scale))
+    folders = generate_frames(workdir, n_frames, shape)
+    ctx = {'workdir': workdir, 'folders': folders, 'bg_dir': os.path.join(workdir, 'background'),
+           'n_frames': n_frames, 'filter_length': filter_length}
+    results = {'meta': {'date': pd.Timestamp.now(tz='UTC').isoformat(), 'host': platform.node(), 'platform': platform.platform(),
+                        'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+                        'cpus': os.cpu_count(), 'frame_shape': shape, 'n_frames': n_frames, 'filter_length': filter_length},
+               'results': {}}
+    for name in (only or BENCHMARKS):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(_run_one, name, ctx).result()
+        results['results'][name] = result
+        if verbose:
+            if 'error' in result:
+                print(f"{name}: FAILED\n{result['error']}")
+            else:
+                stages = ", ".join(f"{stage} {t:.2f}s" for stage, t in result['stages'].items())
+                print(f"{name}: {result['seconds']:.2f}s, {result['frames_per_s']:.2f} frames/s, peak RSS {result['peak_rss_mb']:.0f} MB ({stages})")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='bench_results.json', help="JSON output file")
+    parser.add_argument('--workdir', default=None, help="directory of the synthetic frames (kept between runs). Default: a temporary directory")
+    parser.add_argument('--frames', type=int, default=20, help="number of synthetic frames per RPi")
+    parser.add_argument('--scale', type=float, default=1.0, help="frame size relative to the RPiCamV3 (2592x4608)")
+    parser.add_argument('--filter-length', type=int, default=10, help="window length of the percentile filter")
+    parser.add_argument('--only', nargs='*', choices=sorted(BENCHMARKS), help="benchmarks to run. Default: all")
+    args = parser.parse_args()
+
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(workdir, args.frames, args.scale, args.filter_length, args.only)
+    else:
+        results = run_benchmarks(args.workdir, args.frames, args.scale, args.filter_length, args.only)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.out}")
@@ -0,0 +1,114 @@
+'''
+In-memory LRU cache of decoded (and preprocessed) frames, shared by the background filters.
+
+Overlapping filter windows need the same frames many times. Frames are cached by file path and preprocessing parameters,
+within a memory budget in bytes. Evicted frames can optionally be spilled to disk as compressed .npz files.
+'''
+
+import os, hashlib, threading
+import numpy as np
+from collections import OrderedDict
+
+
+class FrameCache:
+    '''
+    Thread-safe LRU cache of frames keyed by (file path, preprocessing parameters), bounded in bytes.
+    Cached frames are shared and set read-only: copy them before modifying them.
+    '''
+
+    def __init__(self, max_bytes:int=4 * 2**30, spill_dir:str=None):
+        '''
+        :param max_bytes: int, memory budget in bytes. The default (4 GiB) holds ~350 gray 2592x4608 frames.
+        :param spill_dir: str, if provided, evicted frames are saved in this directory and reloaded from it on a later miss.
+        '''
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_hits = 0
+
+    @staticmethod
+    def _key(path, params:tuple):
+        return (os.path.abspath(str(path)), tuple(params))
+
+    def _spill_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, digest + '.npz')
+
+    def get(self, path, params:tuple=()):
+        '''Returns the cached frame, or None if it is not cached (in memory or on disk).'''
+        key = self._key(path, params)
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return frame
+        if self.spill_dir is not None and os.path.exists(self._spill_path(key)):
+            with np.load(self._spill_path(key)) as data:
+                frame = data['frame']
+            with self._lock:
+                self.spill_hits += 1
+            self._insert(key, frame)
+            return frame
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, path, params:tuple, frame:np.ndarray):
+        self._insert(self._key(path, params), frame)
+
+    def _insert(self, key, frame):
+        if frame.nbytes > self.max_bytes:
+            return
+        frame.flags.writeable = False
+        evicted = []
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames.pop(key).nbytes
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes:
+                old_key, old_frame = self._frames.popitem(last=False)
+                self.nbytes -= old_frame.nbytes
+                self.evictions += 1
+                evicted.append((old_key, old_frame))
+        if self.spill_dir is not None:
+            for old_key, old_frame in evicted:
+                if not os.path.exists(self._spill_path(old_key)):
+                    np.savez_compressed(self._spill_path(old_key), frame=old_frame)
+
+    def get_or_compute(self, path, params:tuple, compute):
+        '''
+        Returns the cached frame, computing it with compute() and caching it on a miss.
+        '''
+        frame = self.get(path, params)
+        if frame is None:
+            frame = compute()
+            self.put(path, params, frame)
+        return frame
+
+    def clear(self, spilled:bool=False):
+        '''Empties the cache (and the spill directory if spilled is True). Counters are kept.'''
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+        if spilled and self.spill_dir is not None:
+            for f in os.listdir(self.spill_dir):
+                if f.endswith('.npz'):
+                    os.remove(os.path.join(self.spill_dir, f))
+
+    def stats(self) -> dict:
+        '''Returns the cache counters, to size max_bytes.'''
+        with self._lock:
+            return {'hits': self.hits, 'spill_hits': self.spill_hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'frames': len(self._frames), 'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+frame_cache = FrameCache() # Default cache shared by the filters
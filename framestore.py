@@ -0,0 +1,185 @@
+'''
+Frame store: decoded frames of one hive/RPi/day kept on disk as chunked, memory-mapped uint8 arrays with a timestamp index,
+so that filters and video tools can read them without decoding the JPEGs again.
+
+Layout of a store:
+    <root>/h<hive>r<rpi>/<yymmdd>/meta.json         frame shape, dtype and number of frames per chunk
+    <root>/h<hive>r<rpi>/<yymmdd>/index.csv         one line per frame: timestamp (UTC), image name
+    <root>/h<hive>r<rpi>/<yymmdd>/chunk_00000.npy   (chunk_frames, H, W[, C]) uint8 arrays
+Stores are append-only: frames are added in timestamp order and never modified, so a store can be extended as new captures land.
+'''
+
+import os, json
+import cv2
+import numpy as np
+import pandas as pd
+import dask.array as da
+
+
+class FrameStore:
+    '''
+    Append-only store of the frames of one hive, RPi and day. Behaves as a read-only sequence of frames:
+    store[i] is a memory-mapped view of frame i (no copy, no decoding).
+    '''
+
+    def __init__(self, root:str, hive_nb:int, rpi_num:int, day:str, chunk_frames:int=64):
+        '''
+        Opens the store, or prepares an empty one (created on the first append).
+
+        :param root: str, root directory of the frame stores.
+        :param hive_nb: int, hive number.
+        :param rpi_num: int, RPi number.
+        :param day: str, day of the frames in UTC, 'yymmdd'.
+        :param chunk_frames: int, number of frames per chunk file, for new stores only.
+        '''
+        self.path = os.path.join(str(root), f"h{hive_nb}r{rpi_num}", day)
+        self.hive_nb, self.rpi_num, self.day = hive_nb, rpi_num, day
+        self.meta = None
+        self._chunks = {}
+        self._timestamps = []
+        self.names = []
+        if os.path.exists(os.path.join(self.path, 'meta.json')):
+            with open(os.path.join(self.path, 'meta.json')) as f:
+                self.meta = json.load(f)
+            index = pd.read_csv(os.path.join(self.path, 'index.csv'))
+            self._timestamps = list(pd.to_datetime(index['timestamp'], utc=True))
+            self.names = list(index['name'])
+        else:
+            self._chunk_frames = chunk_frames
+        self._positions = {ts: i for i, ts in enumerate(self._timestamps)}
+
+    @property
+    def shape(self) -> tuple:
+        '''Shape of the whole store, (n_frames, H, W[, C]).'''
+        if self.meta is None:
+            return (0,)
+        return (len(self),) + tuple(self.meta['shape'])
+
+    @property
+    def timestamps(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(self._timestamps)
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def _chunk(self, c:int, mode:str='r'):
+        if (c, mode) not in self._chunks:
+            chunk_path = os.path.join(self.path, f"chunk_{c:05d}.npy")
+            if mode == 'w+':
+                shape = (self.meta['chunk_frames'],) + tuple(self.meta['shape'])
+                self._chunks[(c, mode)] = np.lib.format.open_memmap(chunk_path, mode='w+', dtype=self.meta['dtype'], shape=shape)
+            else:
+                self._chunks[(c, mode)] = np.load(chunk_path, mmap_mode=mode)
+        return self._chunks[(c, mode)]
+
+    def __getitem__(self, i:int) -> np.ndarray:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Frame {i} out of range for a store of {len(self)} frames")
+        c, offset = divmod(i, self.meta['chunk_frames'])
+        return self._chunk(c)[offset]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index_of(self, timestamp:pd.Timestamp) -> int:
+        '''Position of the frame taken at the given tz-aware timestamp. Raises KeyError if there is none.'''
+        return self._positions[pd.Timestamp(timestamp).tz_convert('UTC')]
+
+    def get(self, timestamp:pd.Timestamp) -> np.ndarray:
+        '''Frame taken at the given tz-aware timestamp, or None if there is none.'''
+        try:
+            return self[self.index_of(timestamp)]
+        except KeyError:
+            return None
+
+    def to_dask(self) -> da.Array:
+        '''Lazy (n_frames, H, W[, C]) array over the memory-mapped chunks, with one frame per block.'''
+        if len(self) == 0:
+            raise ValueError(f"Frame store {self.path} is empty")
+        chunk_frames = self.meta['chunk_frames']
+        parts = []
+        for c in range(0, len(self), chunk_frames):
+            count = min(chunk_frames, len(self) - c)
+            part = self._chunk(c // chunk_frames)[:count]
+            parts.append(da.from_array(part, chunks=(1,) + part.shape[1:], name=f"framestore-{self.path}-{c}-{count}"))
+        return da.concatenate(parts, axis=0)
+
+    def append(self, frame:np.ndarray, timestamp:pd.Timestamp, name:str=''):
+        '''
+        Appends a frame to the store. Timestamps (tz-aware) must be strictly increasing.
+        The frame is written before its index line, so an interrupted append leaves the store consistent.
+        '''
+        timestamp = pd.Timestamp(timestamp).tz_convert('UTC')
+        if self._timestamps and timestamp <= self._timestamps[-1]:
+            raise ValueError(f"Frame store is append-only: {timestamp} is not after the last frame ({self._timestamps[-1]})")
+        if self.meta is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.meta = {'shape': list(frame.shape), 'dtype': str(frame.dtype), 'chunk_frames': self._chunk_frames}
+            with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+                json.dump(self.meta, f)
+            with open(os.path.join(self.path, 'index.csv'), 'w') as f:
+                f.write('timestamp,name\n')
+        if list(frame.shape) != self.meta['shape'] or str(frame.dtype) != self.meta['dtype']:
+            raise ValueError(f"Frame of shape {frame.shape} and dtype {frame.dtype} does not match the store ({self.meta['shape']}, {self.meta['dtype']})")
+
+        c, offset = divmod(len(self), self.meta['chunk_frames'])
+        chunk = self._chunk(c, mode='w+' if offset == 0 else 'r+')
+        chunk[offset] = frame
+        chunk.flush()
+        with open(os.path.join(self.path, 'index.csv'), 'a') as f:
+            f.write(f"{timestamp.isoformat()},{name}\n")
+        # Read-only views of this chunk need to be reopened to see the new frame
+        self._chunks.pop((c, 'r'), None)
+        self._positions[timestamp] = len(self._timestamps)
+        self._timestamps.append(timestamp)
+        self.names.append(name)
+
+
+def open_stores(root:str, hive_nb:int, rpi_num:int, days:list[str]=None) -> list[FrameStore]:
+    '''
+    Opens the existing frame stores of a hive and RPi, for the given days ('yymmdd') or for all days, in chronological order.
+    '''
+    rpi_path = os.path.join(str(root), f"h{hive_nb}r{rpi_num}")
+    if days is None:
+        days = sorted(os.listdir(rpi_path)) if os.path.isdir(rpi_path) else []
+    stores = [FrameStore(root, hive_nb, rpi_num, day) for day in sorted(days)]
+    return [store for store in stores if len(store) > 0]
+
+
+def materialize(img_paths:pd.DataFrame, root:str, hive_nb:int, read=None, verbose:bool=False) -> list[FrameStore]:
+    '''
+    Decodes the images of a fetchImagesPaths() dataframe into the frame stores of their hive/RPi/day.
+    Frames already in a store are skipped, so this can be called again to extend the stores with new captures.
+
+    :param img_paths: pd.DataFrame, images paths, indexed by tz-aware datetimes, with one column per RPi (e.g. 'h1r2').
+    :param root: str, root directory of the frame stores.
+    :param hive_nb: int, hive number.
+    :param read: callable, read(path) returns the frame to store. Default: decoding to grayscale with cv2.imread.
+    :return stores: list of FrameStore, the stores that were written to.
+    '''
+    if read is None:
+        read = lambda path: cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    stores = {}
+    for col in img_paths.columns:
+        if col == 'valid':
+            continue
+        rpi_num = int(col[3])
+        for dt, path in img_paths[col].dropna().sort_index().items():
+            dt = pd.Timestamp(dt).tz_convert('UTC')
+            day = dt.strftime('%y%m%d')
+            if (rpi_num, day) not in stores:
+                stores[(rpi_num, day)] = FrameStore(root, hive_nb, rpi_num, day)
+            store = stores[(rpi_num, day)]
+            if len(store) > 0 and dt <= store._timestamps[-1]:
+                continue # Already stored
+            frame = read(path)
+            if frame is None:
+                print(f"[W]: Could not read {path}, skipped.")
+                continue
+            store.append(frame, dt, os.path.basename(path))
+        if verbose:
+            print(f"{col}: {sum(len(s) for (r, _), s in stores.items() if r == rpi_num)} frames stored")
+    return list(stores.values())
@@ -0,0 +1,56 @@
+'''
+Image reading shared by the filters, background and video tools: decodes straight to grayscale (no BGR frame to convert afterwards)
+and, when a scale factor is requested, lets libjpeg downscale while decoding (DCT scaling by 1/2, 1/4 or 1/8),
+which is several times faster and lighter than decoding the full frame and resizing it.
+'''
+
+import cv2
+import numpy as np
+from tracing import traced
+
+# Reduction factor -> imread flags (grayscale, color)
+_REDUCED_FLAGS = {
+    1: (cv2.IMREAD_GRAYSCALE, cv2.IMREAD_COLOR),
+    2: (cv2.IMREAD_REDUCED_GRAYSCALE_2, cv2.IMREAD_REDUCED_COLOR_2),
+    4: (cv2.IMREAD_REDUCED_GRAYSCALE_4, cv2.IMREAD_REDUCED_COLOR_4),
+    8: (cv2.IMREAD_REDUCED_GRAYSCALE_8, cv2.IMREAD_REDUCED_COLOR_8),
+}
+
+
+def _reduction(scale:float) -> int:
+    '''Largest decoder reduction factor that does not go below the requested scale.'''
+    if not 0 < scale <= 1:
+        raise ValueError(f"Scale must be in (0, 1], got {scale}")
+    return max(r for r in _REDUCED_FLAGS if 1 / r >= scale - 1e-9)
+
+
+@traced('decode', path_arg=0)
+def read_image(path, gray:bool=True, scale:float=1.0) -> np.ndarray:
+    '''
+    Reads an image, in grayscale or BGR, at a fraction of its resolution.
+    Scales of 1/2, 1/4 and 1/8 are decoded directly at that size; other scales are decoded at the next larger of these sizes and resized (INTER_AREA).
+
+    :param path: str, path to the image.
+    :param gray: bool, if True, decode straight to a (H, W) grayscale image, else to a (H, W, 3) BGR image.
+    :param scale: float in (0, 1], scale factor of both dimensions.
+    :return img: np.ndarray uint8, or None if the image could not be read (as cv2.imread).
+    '''
+    reduction = _reduction(scale)
+    img = cv2.imread(str(path), _REDUCED_FLAGS[reduction][0 if gray else 1])
+    if img is None or abs(scale * reduction - 1) < 1e-9:
+        return img
+    height, width = img.shape[:2]
+    size = (max(1, round(width * scale * reduction)), max(1, round(height * scale * reduction)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_scale(shape:tuple, target_size:tuple) -> float:
+    '''
+    Smallest decoder scale (1, 1/2, 1/4 or 1/8) at which an image of the given shape (height, width) still covers
+    target_size (width, height), e.g. to decode frames for a display or video of that size before the final resize.
+    '''
+    height, width = shape[:2]
+    target_width, target_height = target_size
+    reduction = max(r for r in _REDUCED_FLAGS if width / r >= target_width and height / r >= target_height) \
+        if width >= target_width and height >= target_height else 1
+    return 1 / reduction
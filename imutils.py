@@ -4,39 +4,126 @@
 
 import cv2 as cv
 import numpy as np
-
-def findVerticalBoardLimits(img):
-    # Perform edge detection
-    edges = cv.Canny(img, 150, 300)
-    # Detect lines using Hough Transform
-    lines = cv.HoughLinesP(edges, 1, np.pi / 180, threshold=200, minLineLength=2600, maxLineGap=1500)
-    h_lines = [line for line in lines if abs(line[0][1] - line[0][3]) < 80] # Horizontal lines
+import os, time, threading
+from functools import partial, lru_cache
+from Preprocessing.preproc import beautify_batch as _beautify_batch
+from imgio import read_image
+from tracing import traced
+
+# Matrices are specific for the camera setup (use these for the 2020 season)
+_CAM_MATRIX = np.array([
+    [3.88774532e+03, 0.00000000e+00, 2.01016942e+03],
+    [0.00000000e+00, 3.90460835e+03, 1.63295552e+03],
+    [0.00000000e+00, 0.00000000e+00, 1.00000000e+00]
+])
+
+_DISTORTION_COEFFS = np.array([[
+    -5.04380784e-01, 3.32158862e-01, -4.75798455e-03, -3.43884435e-04, -1.47282285e-01]])
+
+# Perspective correction of _undistort2: points we want to transform and their target locations, per RPi
+_PERSPECTIVE_POINTS = {
+    'rpi2': ([(78, 95), (3382, 95), (132, 1950), (3263, 1950)],
+             [(0, 0), (3200, 0), (0, 1950), (3200, 1950)]),
+    'rpi4': ([(0, 220), (3200, 250), (32, 1900), (3130, 1850)],
+             [(0, 220), (3200, 220), (0, 1900), (3200, 1900)]),
+}
+_PERSPECTIVE_WIDTH = 3200
+
+_beautify_maps_cache = {} # (rpi, (h, w)) -> fixed-point maps of _undistort + _undistort2, border pixels and their coverage
+
+_BOARD_HEIGHT = 1900 # Pixels between the bottom and the top of the board
+_board_limits_cache = {} # (hive, rpi, day) -> {'limits': (top, bottom, left, right), 'energy': edge energy along the lines when detected}
+
+def _boardBottomLine(edges, scale=1.0):
+    """y of the lowest horizontal line of an edge image, in the edge image pixels (scale: edge image size / full resolution)."""
+    lines = cv.HoughLinesP(edges, 1, np.pi / 180, threshold=int(200 * scale), minLineLength=2600 * scale, maxLineGap=1500 * scale)
+    lines = np.empty((0, 4)) if lines is None else lines.reshape(-1, 4) # (N, 1, 4) or (N, 4) depending on the OpenCV version
+    h_lines = [line for line in lines if abs(line[1] - line[3]) < 80 * scale] # Horizontal lines
 
     if len(h_lines) == 0:
         raise ValueError("No horizontal lines detected")
 
-    lowest_h_line = h_lines[np.argmax([line[0][1] for line in h_lines])]
+    lowest_h_line = h_lines[np.argmax([line[1] for line in h_lines])]
+    return np.mean([lowest_h_line[1], lowest_h_line[3]])
+
+def _boardSideLines(edges, scale=1.0):
+    """x of the leftmost and rightmost vertical lines of an edge image, in the edge image pixels."""
+    lines = cv.HoughLinesP(edges, 1, np.pi / 180, threshold=int(200 * scale), minLineLength=1200 * scale, maxLineGap=600 * scale)
+    lines = np.empty((0, 4)) if lines is None else lines.reshape(-1, 4)
+    v_lines = [line for line in lines if abs(line[0] - line[2]) < 80 * scale] # Vertical lines
 
-    bottom_border = np.mean([lowest_h_line[0][1], lowest_h_line[0][3]])
-    top_border = bottom_border - 1900
+    if len(v_lines) == 0:
+        raise ValueError("No vertical lines detected")
+
+    leftmost_v_line = v_lines[np.argmin([line[0] for line in v_lines])]
+    rightmost_v_line = v_lines[np.argmax([line[0] for line in v_lines])]
+    left_border = np.mean([leftmost_v_line[0], leftmost_v_line[2]])
+    right_border = np.mean([rightmost_v_line[0], rightmost_v_line[2]])
+    return left_border, right_border
+
+def findVerticalBoardLimits(img):
+    # Perform edge detection
+    edges = cv.Canny(img, 150, 300)
+    # Detect lines using Hough Transform
+    bottom_border = _boardBottomLine(edges)
+    top_border = bottom_border - _BOARD_HEIGHT
     return int(top_border), int(bottom_border)
 
 def findHorizontalBoardLimits(img):
     # Perform edge detection
     edges = cv.Canny(img, 150, 300)
     # Detect lines using Hough Transform
-    lines = cv.HoughLinesP(edges, 1, np.pi / 180, threshold=200, minLineLength=1200, maxLineGap=600)
-    v_lines = [line for line in lines if abs(line[0][0] - line[0][2]) < 80] # Vertical lines
-
-    if len(v_lines) == 0:
-        raise ValueError("No vertical lines detected")
-    
-    leftmost_v_line = v_lines[np.argmin([line[0][0] for line in v_lines])]
-    rightmost_v_line = v_lines[np.argmax([line[0][0] for line in v_lines])]
-    left_border = np.mean([leftmost_v_line[0][0], leftmost_v_line[0][2]])
-    right_border = np.mean([rightmost_v_line[0][0], rightmost_v_line[0][2]])
+    left_border, right_border = _boardSideLines(edges)
     return int(left_border), int(right_border)
 
+def _refineBoardLine(img, pos, axis, margin):
+    """Position of the strongest edge line within margin pixels of pos, along axis 0 (a row) or 1 (a column), at full resolution."""
+    start = max(0, int(pos) - margin)
+    stop = min(img.shape[axis], int(pos) + margin + 1)
+    strip = img[start:stop] if axis == 0 else img[:, start:stop]
+    edges = cv.Canny(strip, 150, 300)
+    return start + int(np.argmax(np.count_nonzero(edges, axis=1 - axis)))
+
+def findBoardLimits(img, scale=1.0, refine=True):
+    """Board limits (top, bottom, left, right), with a single edge detection for both directions.
+    With scale < 1, the lines are detected on a downscaled image, then (if refine) each line is moved to the strongest
+    full resolution edge line in a narrow strip around it. With scale=1 the result is the same as
+    findVerticalBoardLimits() and findHorizontalBoardLimits()."""
+    small = img if scale == 1.0 else cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    edges = cv.Canny(small, 150, 300)
+    bottom = _boardBottomLine(edges, scale) / scale
+    left, right = (x / scale for x in _boardSideLines(edges, scale))
+    if scale != 1.0 and refine:
+        margin = int(np.ceil(2 / scale))
+        bottom = _refineBoardLine(img, bottom, 0, margin)
+        left = _refineBoardLine(img, left, 1, margin)
+        right = _refineBoardLine(img, right, 1, margin)
+    return int(bottom - _BOARD_HEIGHT), int(bottom), int(left), int(right)
+
+def _boardEdgeEnergy(img, limits, margin=3):
+    """Fraction of the bottom, left and right board lines covered by edges (within margin pixels), for cache validation."""
+    _, bottom, left, right = limits
+    energy = []
+    for pos, axis in [(bottom, 0), (left, 1), (right, 1)]:
+        start = max(0, pos - margin)
+        strip = img[start:pos + margin + 1] if axis == 0 else img[:, start:pos + margin + 1]
+        edges = cv.Canny(strip, 150, 300)
+        energy.append(np.count_nonzero(edges.any(axis=axis)) / max(1, edges.shape[1 - axis]))
+    return np.array(energy)
+
+def getBoardLimits(img, hive_nb, rpi_num, day, scale=0.25, min_energy_ratio=0.5):
+    """Board limits (top, bottom, left, right) of a frame, cached per (hive, RPi, day) since the camera is fixed.
+    The cached limits are revalidated on each frame by the edge energy along the cached lines (three narrow strips):
+    they are detected again with findBoardLimits(img, scale) when the energy of a line drops below min_energy_ratio
+    times its energy at detection."""
+    key = (hive_nb, rpi_num, day)
+    cached = _board_limits_cache.get(key)
+    if cached is not None:
+        if np.all(_boardEdgeEnergy(img, cached['limits']) >= min_energy_ratio * cached['energy']):
+            return cached['limits']
+    limits = findBoardLimits(img, scale=scale)
+    _board_limits_cache[key] = {'limits': limits, 'energy': _boardEdgeEnergy(img, limits)}
+    return limits
 
 def _undistort(img):
     """Remove distortions from the image using calibration data.
@@ -46,38 +133,40 @@ def _undistort(img):
     # Shape of the image
     h, w = img.shape[:2]
 
-    # Matrices are specific for the camera setup (use these for the 2020 season)
-    _cam_matrix = np.array([
-        [3.88774532e+03, 0.00000000e+00, 2.01016942e+03],
-        [0.00000000e+00, 3.90460835e+03, 1.63295552e+03],
-        [0.00000000e+00, 0.00000000e+00, 1.00000000e+00]
-    ])
-
-    _distortion_coeffs = np.array([[
-        -5.04380784e-01, 3.32158862e-01, -4.75798455e-03, -3.43884435e-04, -1.47282285e-01]])
-
     # Refine cam matrix and compute ROI
-    newcameramtx, roi = cv.getOptimalNewCameraMatrix(_cam_matrix, _distortion_coeffs, (w, h), 1, (w, h))
+    newcameramtx, roi = _undistort_camera_matrix(w, h)
 
     # Undistort
     dst = cv.undistort(
         img,
-        _cam_matrix,
-        _distortion_coeffs,
+        _CAM_MATRIX,
+        _DISTORTION_COEFFS,
         None,
         newcameramtx,
     )
 
     # Crop the image
     x, y, w, h = roi
+    dst = dst[y: y + h, x: x + w]
+
+    return dst
+
+def _undistort_camera_matrix(w, h):
+    '''Refined camera matrix and crop ROI (with even numbers of rows and cols) of _undistort for images of size (w, h).'''
+    newcameramtx, roi = cv.getOptimalNewCameraMatrix(_CAM_MATRIX, _DISTORTION_COEFFS, (w, h), 1, (w, h))
+    x, y, w, h = roi
     # Ensure even numbers of pixels in rows and cols
     if w % 2 != 0:
         w -= 1
     if h % 2 != 0:
         h -= 1
-    dst = dst[y: y + h, x: x + w]
+    return newcameramtx, (x, y, w, h)
 
-    return dst
+def _perspective_matrix(rpi):
+    if rpi not in _PERSPECTIVE_POINTS:
+        raise ValueError(f"No perspective correction for {rpi}, expected one of {list(_PERSPECTIVE_POINTS)}")
+    pts_src, pts_tgt = _PERSPECTIVE_POINTS[rpi]
+    return cv.getPerspectiveTransform(np.float32(pts_src), np.float32(pts_tgt))
 
 
 def _undistort2(img, rpi):
@@ -85,66 +174,47 @@ def _undistort2(img, rpi):
         Ref:
         https://pysource.com/2018/02/14/perspective-transformation-opencv-3-4-with-python-3-tutorial-13/
     """
+    matrix = _perspective_matrix(rpi)
+    result = cv.warpPerspective(img, matrix, (_PERSPECTIVE_WIDTH, img.shape[0]))
 
-    if rpi == 'rpi2':
-        # Points we want to transform
-        pa1 = (78, 95)
-        pa2 = (3382, 95)
-        pa3 = (132, 1950)
-        pa4 = (3263, 1950)
-
-        # cv.circle(img, pa1, 5, (0, 0, 255), -1)
-        # cv.circle(img, pa2, 5, (0, 0, 255), -1)
-        # cv.circle(img, pa3, 5, (0, 0, 255), -1)
-        # cv.circle(img, pa4, 5, (0, 0, 255), -1)
-
-        # Target locations for the points to move to
-        pb1 = (0, 0)
-        pb2 = (3200, 0)
-        pb3 = (0, 1950)
-        pb4 = (3200, 1950)
-
-        # cv.circle(img, pb1, 15, (0, 200, 255), -1)
-        # cv.circle(img, pb2, 15, (0, 200, 255), -1)
-        # cv.circle(img, pb3, 15, (0, 200, 255), -1)
-        # cv.circle(img, pb4, 15, (0, 200, 255), -1)
-
-        # result = img
-        pts_src = np.float32([list(pa1), list(pa2), list(pa3), list(pa4)])
-        pts_tgt = np.float32([list(pb1), list(pb2), list(pb3), list(pb4)])
-
-        matrix = cv.getPerspectiveTransform(pts_src, pts_tgt)
-        result = cv.warpPerspective(img, matrix, (3200, img.shape[0]))
-
-    elif rpi == 'rpi4':
-        # Points we want to transform
-        pa1 = (0, 220)
-        pa2 = (3200, 250)
-        pa3 = (32, 1900)
-        pa4 = (3130, 1850)
-
-        # cv.circle(img, pa1, 5, (0, 0, 255), -1)
-        # cv.circle(img, pa2, 5, (0, 0, 255), -1)
-        # cv.circle(img, pa3, 5, (0, 0, 255), -1)
-        # cv.circle(img, pa4, 5, (0, 0, 255), -1)
-
-        # Target locations for the points to move to
-        pb1 = (0, 220)
-        pb2 = (3200, 220)
-        pb3 = (0, 1900)
-        pb4 = (3200, 1900)
-
-        # cv.circle(img, pb1, 15, (0, 200, 255), -1)
-        # cv.circle(img, pb2, 15, (0, 200, 255), -1)
-        # cv.circle(img, pb3, 15, (0, 200, 255), -1)
-        # cv.circle(img, pb4, 15, (0, 200, 255), -1)
-
-        pts_src = np.float32([list(pa1), list(pa2), list(pa3), list(pa4)])
-        pts_tgt = np.float32([list(pb1), list(pb2), list(pb3), list(pb4)])
-
-        matrix = cv.getPerspectiveTransform(pts_src, pts_tgt)
-        result = cv.warpPerspective(img, matrix, (3200, img.shape[0]))
+    return result
 
+
+def _beautify_maps(rpi, shape):
+    """Fixed-point (CV_16SC2) maps applying _undistort then _undistort2 to an image of the given shape, and the pixels
+    at the border of the warped image with their coverage, cached per (rpi, shape)."""
+    key = (rpi, tuple(shape[:2]))
+    if key not in _beautify_maps_cache:
+        h, w = shape[:2]
+        newcameramtx, (x, y, w_crop, h_crop) = _undistort_camera_matrix(w, h)
+        # Position in the raw image of each pixel of the undistorted image
+        map_x, map_y = cv.initUndistortRectifyMap(_CAM_MATRIX, _DISTORTION_COEFFS, None, newcameramtx, (w, h), cv.CV_32FC1)
+        # Warping the maps of the cropped image gives, for each output pixel, its position in the raw image.
+        # The maps are extended past the crop (BORDER_REPLICATE) so that they are not interpolated with off-image positions
+        # at its edges. The coverage of each output pixel by the cropped image (warped mask of ones) then sends the pixels
+        # fully outside of it off the raw image (black, as with warpPerspective), and gives the weight of the border pixels,
+        # which warpPerspective blends with black.
+        matrix = _perspective_matrix(rpi)
+        size = (_PERSPECTIVE_WIDTH, h_crop)
+        map_x, map_y = [cv.warpPerspective(m[y: y + h_crop, x: x + w_crop], matrix, size, flags=cv.INTER_LINEAR,
+                                           borderMode=cv.BORDER_REPLICATE) for m in (map_x, map_y)]
+        coverage = cv.warpPerspective(np.ones((h_crop, w_crop), np.float32), matrix, size, flags=cv.INTER_LINEAR,
+                                      borderMode=cv.BORDER_CONSTANT, borderValue=0)
+        outside = coverage <= 1e-3
+        map_x[outside] = -1
+        map_y[outside] = -1
+        border = np.flatnonzero(~outside & (coverage < 1 - 1e-3))
+        _beautify_maps_cache[key] = cv.convertMaps(map_x, map_y, cv.CV_16SC2) + (border, coverage.ravel()[border])
+    return _beautify_maps_cache[key]
+
+
+def _undistort_fused(img, rpi):
+    """Same as _undistort2(_undistort(img), rpi), with a single resampling through cached remap maps."""
+    map1, map2, border, coverage = _beautify_maps(rpi, img.shape)
+    result = cv.remap(img, map1, map2, cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT, borderValue=0)
+    # Border pixels, partly covered by the cropped image: blended with black
+    flat = result.reshape(result.shape[0] * result.shape[1], -1)
+    flat[border] = (flat[border] * coverage[:, None] + 0.5).astype(result.dtype)
     return result
 
 
@@ -158,22 +228,30 @@ def _unsharp_mask(
     https://en.wikipedia.org/wiki/Unsharp_masking
     https://homepages.inf.ed.ac.uk/rbf/HIPR2/unsharp.htm"""
     blurred = cv.GaussianBlur(image, kernel_size, sigma)
-    sharpened = float(amount + 1) * image - float(amount) * blurred
-    sharpened = np.maximum(sharpened, np.zeros(sharpened.shape))
-    sharpened = np.minimum(sharpened, 255 * np.ones(sharpened.shape))
-    sharpened = sharpened.round().astype(np.uint8)
+    if image.dtype == np.uint8:
+        # Saturating uint8 arithmetic, without float64 temporaries
+        sharpened = cv.addWeighted(image, float(amount + 1), blurred, -float(amount), 0)
+    else:
+        sharpened = float(amount + 1) * image.astype(np.float32) - float(amount) * blurred.astype(np.float32)
+        np.clip(sharpened, 0, 255, out=sharpened)
+        sharpened = sharpened.round().astype(np.uint8)
     if threshold > 0:
-        low_contrast_mask = np.absolute(image - blurred) < threshold
-        # OpenCV4 function copyTo
-        np.copyTo(sharpened, image, where=low_contrast_mask)
+        low_contrast_mask = cv.absdiff(image, blurred) < threshold
+        np.copyto(sharpened, image, where=low_contrast_mask, casting='unsafe')
     return sharpened
 
 
-def beautify_frame(img, rpi):
-    """Undistort, sharpen, hist-equalize and label image."""
+@traced()
+def beautify_frame(img, rpi, fused_remap=True):
+    """Undistort, sharpen, hist-equalize and label image.
+    With fused_remap, both undistortions are done in a single remap with maps cached per (rpi, image shape),
+    instead of two full-frame resamplings (differences with the two-step result are interpolation rounding only)."""
 
-    img = _undistort(img)
-    img = _undistort2(img, rpi)
+    if fused_remap:
+        img = _undistort_fused(img, rpi)
+    else:
+        img = _undistort(img)
+        img = _undistort2(img, rpi)
     img = _unsharp_mask(img, amount=1.5)
 
     # Histogram equalization
@@ -182,7 +260,27 @@ def beautify_frame(img, rpi):
 
     return img
 
-def compute_dense_optical_flow(prev_image, current_image):
+def beautify_batch(frames, rpi, out=None, n_threads=None, verbose=False):
+    """Same as beautify_frame() on a batch of frames (or paths), on a thread pool.
+    See Preprocessing.preproc.beautify_batch for the output and the per-stage timings."""
+    return _beautify_batch(frames, out=out, undistort=partial(_undistort_fused, rpi=rpi), n_threads=n_threads, verbose=verbose)
+
+def board_roi(img):
+    """Region of the frame covered by the board, (top, bottom, left, right) in pixels, from the detected board limits.
+    Can be computed once per RPi and passed to compute_dense_optical_flow() as roi."""
+    h, w = img.shape[:2]
+    top, bottom, left, right = findBoardLimits(img)
+    return max(0, top), min(h, bottom), max(0, left), min(w, right)
+
+@traced()
+def compute_dense_optical_flow(prev_image, current_image, scale=1.0, roi=None, magnitude_only=False, init_flow=None):
+    """Dense Farneback optical flow between two grayscale frames.
+    Args:
+        scale: the flow is computed on frames resized by this factor, then upsampled and rescaled back to full resolution pixels.
+        roi: (top, bottom, left, right), e.g. from board_roi(). The flow is only computed inside it and is 0 elsewhere.
+        magnitude_only: skip the angle computation, which is returned as None.
+        init_flow: flow of the previous frame pair (as returned by this function), used as initial estimate (OPTFLOW_USE_INITIAL_FLOW).
+    Returns the flow (H, W, 2), its magnitude and its angle in degrees, all at full resolution."""
     old_shape = current_image.shape
     # prev_image_gray = cv.cvtColor(prev_image, cv.COLOR_BGR2GRAY)
     # current_image_gray = cv.cvtColor(current_image, cv.COLOR_BGR2GRAY)
@@ -190,34 +288,163 @@ def compute_dense_optical_flow(prev_image, current_image):
     prev_image_gray = prev_image
     current_image_gray = current_image
 
+    if roi is not None:
+        top, bottom, left, right = roi
+        prev_image_gray = prev_image_gray[top:bottom, left:right]
+        current_image_gray = current_image_gray[top:bottom, left:right]
+        if init_flow is not None:
+            init_flow = init_flow[top:bottom, left:right]
+    roi_h, roi_w = current_image_gray.shape[:2]
+
+    if scale != 1.0:
+        small_size = (max(1, round(roi_w * scale)), max(1, round(roi_h * scale)))
+        prev_image_gray = cv.resize(prev_image_gray, small_size, interpolation=cv.INTER_AREA)
+        current_image_gray = cv.resize(current_image_gray, small_size, interpolation=cv.INTER_AREA)
+        if init_flow is not None:
+            init_flow = cv.resize(init_flow, small_size, interpolation=cv.INTER_AREA) * np.float32(scale)
+
+    flags = 0
+    if init_flow is not None:
+        # Farneback refines the given flow in place
+        init_flow = np.array(init_flow, dtype=np.float32, order='C')
+        flags = cv.OPTFLOW_USE_INITIAL_FLOW
+
     # assert current_image.shape == old_shape
     # hsv = np.zeros_like(prev_image)
     # hsv[..., 1] = 255
 
     _flow = cv.calcOpticalFlowFarneback(prev=prev_image_gray,
-                                     next=current_image_gray, flow=None,
+                                     next=current_image_gray, flow=init_flow,
                                      pyr_scale=0.5, # PyrScale=0.5 means a classical pyramid, where each next layer is twice smaller than the previous one. default 0.5.
                                      levels=3,      # Number of pyramid layers including the initial image. Levels=1 means that no extra layers are created and only the original images are used. default 5.
                                      winsize=15,    # Averaging window size. Larger values increase the algorithm robustness to image noise and give more chances for fast motion detection, but yield more blurred motion field. default 13.
                                      iterations=3,  # Number of iterations the algorithm does at each pyramid level. default 10.
                                      poly_n=5,      # Size of the pixel neighborhood used to find polynomial expansion in each pixel. Larger values mean that the image will be approximated with smoother surfaces, yielding more robust algorithm and more blurred motion field. Typically, PolyN is 5 or 7. default 5.
                                      poly_sigma=1.2,# Standard deviation of the Gaussian that is used to smooth derivatives used as a basis for the polynomial expansion. For PolyN=5, you can set PolySigma = 1.1. For PolyN=7, a good value would be PolySigma = 1.5. default 1.1.
-                                     flags=0)
+                                     flags=flags)
+
+    if scale != 1.0:
+        # Back to full resolution pixels, both the grid and the vectors
+        _flow = cv.resize(_flow, (roi_w, roi_h), interpolation=cv.INTER_LINEAR)
+        _flow *= np.float32(1 / scale)
 
+    if roi is not None:
+        full_flow = np.zeros(old_shape[:2] + (2,), dtype=np.float32)
+        full_flow[top:bottom, left:right] = _flow
+        _flow = full_flow
 
     # mag, ang = cv.cartToPolar(flow[..., 0], flow[..., 1])
     # hsv[..., 0] = ang * 180 / np.pi / 2
     # hsv[..., 2] = cv.normalize(mag, None, 0, 255, cv.NORM_MINMAX)
 
     # return flow, cv.cvtColor(hsv, cv.COLOR_HSV2BGR)
+    if magnitude_only:
+        return _flow, cv.magnitude(_flow[..., 0], _flow[..., 1]), None
     _of_mag, _of_ang = cv.cartToPolar(_flow[..., 0], _flow[..., 1], angleInDegrees=True)
 
     return _flow, _of_mag, _of_ang
 
-def find_biggest_active_area( of_magintude ):
+MORPH_METHODS = ('exact', 'decompose', 'downsample', 'distance')
+
+@lru_cache(maxsize=None)
+def _ellipse_kernel(ksize):
+    return cv.getStructuringElement(cv.MORPH_ELLIPSE, ksize)
+
+def _binary_dilate_distance(mask, radius):
+    # Distance of each pixel to the nearest foreground pixel
+    dist = cv.distanceTransform(cv.compare(mask, 0, cv.CMP_EQ), cv.DIST_L2, cv.DIST_MASK_PRECISE)
+    return cv.compare(dist, radius, cv.CMP_LE)
+
+def _binary_erode_distance(mask, radius):
+    # Distance of each pixel to the nearest background pixel (outside the image counts as foreground, as in cv.erode)
+    dist = cv.distanceTransform(cv.compare(mask, 0, cv.CMP_GT), cv.DIST_L2, cv.DIST_MASK_PRECISE)
+    return cv.compare(dist, radius, cv.CMP_GT)
+
+def _pool_mask(mask, factor, dilate=True):
+    # Binary mask downsampled by factor: max (dilate) or min pooling over factor x factor blocks, the image padded as cv.dilate/erode do
+    h, w = mask.shape[:2]
+    pad_h, pad_w = -h % factor, -w % factor
+    if pad_h or pad_w:
+        mask = cv.copyMakeBorder(mask, 0, pad_h, 0, pad_w, cv.BORDER_CONSTANT, value=0 if dilate else 255)
+    blocks = mask.reshape((h + pad_h) // factor, factor, (w + pad_w) // factor, factor)
+    small = blocks.max(axis=(1, 3)) if dilate else blocks.min(axis=(1, 3))
+    return cv.compare(small, 0, cv.CMP_GT)
+
+def morphology(mask, op, ksize, method='exact', step=15, factor=4):
+    """Morphological operation (cv.MORPH_DILATE, ERODE, OPEN or CLOSE) of a mask with an ellipse of size ksize (w, h),
+    with faster approximations for large kernels:
+        'exact': cv.morphologyEx with the full ellipse.
+        'decompose': repeated operations with an ellipse of about step pixels, whose successive dilations add up to the large one.
+        'downsample': the operation on the mask downsampled by factor, upsampled back and thresholded at half.
+            The mask is downsampled as a binary mask: a block of factor x factor pixels is foreground if any of its pixels is
+            (dilate, close), or if all of them are (erode, open). A dilation or a closing thus keeps features of any size, and
+            an erosion or an opening removes features narrower than factor pixels, as the exact operation does with kernels larger than factor.
+            Boundaries are only accurate to about factor pixels: use it for kernels several times larger than factor, on masks
+            whose features and gaps are much larger than factor pixels. Small isolated features (a few pixels) are kept, but the
+            pixels filled around them can differ by a block each (e.g. IoU 0.3-0.4 with the exact closing of sparse dots by a 39 px
+            ellipse at factor 4, against 0.97-1.0 for blobs of tens of pixels or thresholded smooth noise at 155 px).
+        'distance': thresholded distance transforms (the kernel is taken as a disc of diameter min(ksize)).
+    The approximations return a binary uint8 mask (0 or 255), see morphology_accuracy() for their difference with 'exact'."""
+    ksize = tuple(int(k) for k in ksize)
+    if method == 'exact':
+        return cv.morphologyEx(mask, op, _ellipse_kernel(ksize))
+    if method not in MORPH_METHODS:
+        raise ValueError(f"Unknown morphology method {method}, expected one of {MORPH_METHODS}")
+    mask = cv.compare(mask, 0, cv.CMP_GT) if mask.dtype != np.uint8 else mask
+
+    if method == 'decompose':
+        n = max(1, round((max(ksize) - 1) / (step - 1)))
+        small = tuple(2 * max(1, round((k - 1) / 2 / n)) + 1 for k in ksize)
+        return cv.morphologyEx(mask, op, _ellipse_kernel(small), iterations=n)
+
+    if method == 'downsample':
+        h, w = mask.shape[:2]
+        extensive = op in (cv.MORPH_DILATE, cv.MORPH_CLOSE)
+        pooled = _pool_mask(mask, factor, dilate=extensive)
+        small = cv.morphologyEx(pooled, op, _ellipse_kernel(tuple(max(1, round(k / factor)) for k in ksize)))
+        if extensive:
+            # Blocks holding foreground are only kept whole inside the result, elsewhere their pixels of the mask are
+            small = cv.bitwise_and(small, cv.bitwise_or(cv.bitwise_not(pooled), cv.erode(small, _ellipse_kernel((3, 3)))))
+        small = cv.resize(small, (pooled.shape[1] * factor, pooled.shape[0] * factor), interpolation=cv.INTER_LINEAR)[:h, :w]
+        result = cv.compare(small, 127, cv.CMP_GT)
+        # Dilations and closings contain the mask, erosions and openings are contained in it
+        mask = cv.compare(mask, 0, cv.CMP_GT)
+        return cv.bitwise_or(result, mask) if extensive else cv.bitwise_and(result, mask)
+
+    radius = (min(ksize) - 1) / 2
+    if op == cv.MORPH_DILATE:
+        return _binary_dilate_distance(mask, radius)
+    if op == cv.MORPH_ERODE:
+        return _binary_erode_distance(mask, radius)
+    if op == cv.MORPH_OPEN:
+        return _binary_dilate_distance(_binary_erode_distance(mask, radius), radius)
+    if op == cv.MORPH_CLOSE:
+        return _binary_erode_distance(_binary_dilate_distance(mask, radius), radius)
+    raise ValueError(f"Unsupported morphological operation {op}")
+
+def morphology_accuracy(mask, op, ksize, methods=MORPH_METHODS, **kwargs):
+    """Compares the morphology() methods with the exact result on a mask.
+    Returns {method: {'seconds', 'differing_pixels', 'differing_ratio', 'iou'}}, with the IoU of the foregrounds."""
+    exact = None
+    report = {}
+    for method in ('exact',) + tuple(m for m in methods if m != 'exact'):
+        t0 = time.perf_counter()
+        result = morphology(mask, op, ksize, method=method, **kwargs)
+        seconds = time.perf_counter() - t0
+        result = result > 0
+        if exact is None:
+            exact = result
+        union = np.count_nonzero(exact | result)
+        differing = np.count_nonzero(exact ^ result)
+        report[method] = {'seconds': seconds, 'differing_pixels': int(differing), 'differing_ratio': differing / result.size,
+                          'iou': int(np.count_nonzero(exact & result)) / union if union else 1.0}
+    return report
+
+def find_biggest_active_area( of_magintude, morph_method='exact' ):
     '''
     Find the biggest active area of an optical flow scalar (magnitude) field.
     of_magnitude can be computed using <compute_dense_optical_flow()>
+    morph_method: method of the large closing, see morphology()
     '''
     # higher values select areas with higher activities
     # So, it is more selective (smaller contour)
@@ -227,11 +454,8 @@ def find_biggest_active_area( of_magintude ):
     ## Morphological opening and closing to improve mask
     # kernel1 = np.ones((5,5), np.uint8)
     # kernel2 = np.ones((100,100), np.uint8)
-    kernel1 = cv.getStructuringElement(cv.MORPH_ELLIPSE, (15, 15))
-    kernel2 = cv.getStructuringElement(cv.MORPH_ELLIPSE, (140, 140))
-
-    mask_morph = cv.morphologyEx(thresh, cv.MORPH_OPEN, kernel1)
-    mask_morph = cv.morphologyEx(thresh, cv.MORPH_CLOSE, kernel2)
+    mask_morph = morphology(thresh, cv.MORPH_OPEN, (15, 15))
+    mask_morph = morphology(thresh, cv.MORPH_CLOSE, (140, 140), method=morph_method)
 
     ## Find contours
     # Convert binary image from float to int
@@ -294,42 +518,67 @@ def plot_of_quiver(ax, flow, spacing, margin=0, **kwargs):
     ax.set_ylim(sorted(ax.get_ylim(), reverse=True))
     ax.set_aspect("equal")
 
-def load_bg_img( bg_dir, scale_factor=1.0 ):
-    _bg = cv.imread(str(bg_dir) + 'final_background_rpi2.jpg')
-    _bg = cv.resize(_bg, (0, 0), fx=scale_factor, fy=scale_factor)
-    _bg = cv.GaussianBlur(_bg, (55, 55), 0)
-    _bg = cv.equalizeHist(cv.cvtColor(_bg, cv.COLOR_BGR2GRAY))
+_bg_cache = {} # (path, rpi, scale_factor, reduced_decode) -> (file mtime, processed background)
+_bg_cache_lock = threading.Lock()
+
+def load_bg_img( bg_dir, scale_factor=1.0, rpi='rpi2', reduced_decode=False ):
+    '''Background of an RPi (bg_dir + final_background_<rpi>.jpg), resized, blurred and equalized for find_cluster_contour().
+    With reduced_decode, the background is decoded straight to grayscale at scale_factor (see imgio.read_image) instead of
+    decoding it in full and resizing it (faster for small scale factors, results differ by rounding only).
+    Processed backgrounds are cached per (path, rpi, scale_factor, reduced_decode) until the file changes, and shared between callers
+    (and threads): the returned array is read-only.'''
+    path = os.path.abspath(str(bg_dir) + 'final_background_%s.jpg' % rpi)
+    key = (path, rpi, scale_factor, reduced_decode)
+    mtime = os.stat(path).st_mtime_ns
+    with _bg_cache_lock:
+        cached = _bg_cache.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        _bg = read_image(path, gray=True, scale=scale_factor) if reduced_decode else cv.imread(path)
+        if _bg is None:
+            raise ValueError(f"Could not read background {path}")
+        if reduced_decode:
+            _bg = cv.equalizeHist(cv.GaussianBlur(_bg, (55, 55), 0))
+        else:
+            _bg = cv.resize(_bg, (0, 0), fx=scale_factor, fy=scale_factor)
+            _bg = cv.GaussianBlur(_bg, (55, 55), 0)
+            _bg = cv.equalizeHist(cv.cvtColor(_bg, cv.COLOR_BGR2GRAY))
+        _bg.setflags(write=False)
+        _bg_cache[key] = (mtime, _bg)
 
     return _bg
 
-def find_cluster_contour( cluster_img, bg_img ):
-    '''Method developed by Martin S.'''
+# Segmentation thresholds of find_cluster_contour, per background intensity band
+_CLUSTER_BG_THRESHOLD1 = 180
+_CLUSTER_BG_THRESHOLD2 = 70
+_CLUSTER_THRESHOLD_LUT = np.full(256, 255, dtype=np.uint8) # Background value -> image threshold. 255 (never above) on the band limits
+_CLUSTER_THRESHOLD_LUT[_CLUSTER_BG_THRESHOLD1 + 1:] = 175
+_CLUSTER_THRESHOLD_LUT[_CLUSTER_BG_THRESHOLD2 + 1:_CLUSTER_BG_THRESHOLD1] = 140
+_CLUSTER_THRESHOLD_LUT[:_CLUSTER_BG_THRESHOLD2] = 80
+_CLUSTER_OPEN_KERNEL = cv.getStructuringElement(cv.MORPH_ELLIPSE, (16, 16))
+_CLUSTER_CLOSE_SIZE = (155, 155) # Ellipse of the closing, see morphology()
+
+def build_threshold_map( bg_img ):
+    '''Per-pixel segmentation threshold of find_cluster_contour for a background from load_bg_img():
+    175 where bg > 180, 140 where 70 < bg < 180, 80 where bg < 70 and 255 (never segmented) where bg is exactly 70 or 180.
+    The map only depends on the background, so it can be built once and reused for all the frames of a day.'''
+    return cv.LUT(bg_img, _CLUSTER_THRESHOLD_LUT)
+
+@traced()
+def find_cluster_contour( cluster_img, bg_img, thresh_map=None, morph_method='exact' ):
+    '''Method developed by Martin S.
+    thresh_map: optional, build_threshold_map(bg_img), to avoid rebuilding it for each frame (bg_img can then be None).
+    morph_method: method of the large closing, see morphology().'''
     # use load_bg_img()
-    bg = bg_img
+    if thresh_map is None:
+        thresh_map = build_threshold_map(bg_img)
 
     _img = cv.GaussianBlur(cluster_img, (55, 55), 0)
     _img = cv.equalizeHist(_img)
 
-    thresh = np.zeros_like(_img)
-
-    threshold1 = 180
-    threshold2 = 70
-
-    img_thresh1 = np.full_like(_img, 255)
-    img_thresh2 = np.full_like(_img, 255)
-    img_thresh3 = np.full_like(_img, 255)
-
-    img_thresh1[(bg > threshold1)] = _img[(bg > threshold1)]
-    img_thresh2[(bg > threshold2) & (bg < threshold1)] = _img[(bg > threshold2) & (bg < threshold1)]
-    img_thresh3[(bg < threshold2)] = _img[(bg < threshold2)]
-
-    ret, thresh1 = cv.threshold(img_thresh1, 175, 255, 0)
-    ret, thresh2 = cv.threshold(img_thresh2, 140, 255, 0)
-    ret, thresh3 = cv.threshold(img_thresh3, 80, 255, 0)
-
-    thresh[(bg > threshold1)] = thresh1[(bg > threshold1)]
-    thresh[(bg > threshold2) & (bg < threshold1)] = thresh2[(bg > threshold2) & (bg < threshold1)]
-    thresh[(bg < threshold2)] = thresh3[(bg < threshold2)]
+    # Three-band thresholding: 255 where the image is above the threshold of its background band
+    thresh = cv.compare(_img, thresh_map, cv.CMP_GT)
 
     # ret, thresh = cv2.threshold(img, 115, 255, 0)
     #thresh = cv2.GaussianBlur(thresh,(35,35),0)
@@ -338,13 +587,14 @@ def find_cluster_contour( cluster_img, bg_img ):
     mask_morph = cv.morphologyEx(
             thresh,
             cv.MORPH_OPEN,
-            cv.getStructuringElement(cv.MORPH_ELLIPSE, (16, 16))
+            _CLUSTER_OPEN_KERNEL
     )
 
-    mask_morph = cv.morphologyEx(
+    mask_morph = morphology(
             mask_morph,
             cv.MORPH_CLOSE,
-            cv.getStructuringElement(cv.MORPH_ELLIPSE, (155, 155))
+            _CLUSTER_CLOSE_SIZE,
+            method=morph_method
     )
 
     mask_morph[0, :] = 255
@@ -370,6 +620,13 @@ def find_cluster_contour( cluster_img, bg_img ):
 
     return (cx, cy), _biggest_contour, _contour_areas[_biggest_contour_idx-1], _some_img
 
+def find_cluster_contours( cluster_imgs, bg_img=None, thresh_map=None, morph_method='exact' ):
+    '''find_cluster_contour() on a batch of frames sharing the same background: the threshold map is built once
+    (from bg_img, unless thresh_map is given) and the morphology kernels are shared. Returns the list of results.'''
+    if thresh_map is None:
+        thresh_map = build_threshold_map(bg_img)
+    return [find_cluster_contour(img, None, thresh_map=thresh_map, morph_method=morph_method) for img in cluster_imgs]
+
 def px_to_mm(_img, _val, _rpi, _axis):
     ''' This function is tuned to undistorted images with the specific script (???.py)
     ex: cenX = px_to_mm(img2, cX, rpi, _axis='x')
@@ -437,7 +694,7 @@ if __name__ == "__main__":
     elif "rpi4" in f_img:
         rpi = 'rpi4'
 
-    bg_img = load_bg_img('./outputs/2_zigzag/background/%s/' % rpi)
+    bg_img = load_bg_img('./outputs/2_zigzag/background/%s/' % rpi, rpi=rpi)
 
     img = cv.imread(f_img, cv.IMREAD_GRAYSCALE)
     img_beauty = beautify_frame(img, rpi)
@@ -6,14 +6,129 @@ Initial date: 18/07/2025
 '''
 
 import pandas as pd
-import os, sys
+import os, sys, re, pickle, tempfile
 from tqdm import tqdm
 from dask import delayed, compute
 from HiveOpenings.libOpenings import * # To filter out invalid datetimes
+from tracing import traced
 
 RPiCamV3_img_shape = (2592, 4608)   # Height, Width
 RPiCamV3_img_shape_RGB = (2592, 4608, 3)   # Height, Width, Channels
 
+class ImageCatalog:
+    '''
+    Index of the images contained in the RPi folders of a root path, so that images can be fetched without listing the folders for every datetime.
+    Each folder is indexed by the 'hiveN_rpiM_yymmdd-HHMM' prefix of its filenames. The catalog is saved in the root path (if writable)
+    and refreshed incrementally: a folder is only rescanned when its mtime changed, and only the new filenames are parsed.
+    '''
+    CATALOG_NAME = '.imgcatalog.pkl'
+    _NAME_RE = re.compile(r'hive\d+_rpi\d+_\d{6}-\d{4}')
+
+    def __init__(self, rootpath_imgs:str, persist:bool=True):
+        '''
+        :param rootpath_imgs: str, root path to the images, containing one folder per RPi.
+        :param persist: bool, if True, the catalog is loaded from and saved to the root path.
+        '''
+        self.rootpath = str(rootpath_imgs)
+        self.persist = persist
+        self._folders = {}  # folder name -> {'mtime': int, 'names': set of filenames, 'index': {prefix: filename}}
+        if persist:
+            self._load()
+
+    def _catalog_path(self):
+        return os.path.join(self.rootpath, self.CATALOG_NAME)
+
+    def _load(self):
+        # A missing, torn or outdated catalog is rebuilt by the next refresh
+        try:
+            with open(self._catalog_path(), 'rb') as f:
+                folders = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError, ValueError):
+            folders = {}
+        self._folders = folders if isinstance(folders, dict) else {}
+
+    def _save(self):
+        # Written to a file of its own then renamed, so that processes refreshing the same root never replace the catalog with a torn file
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.rootpath, prefix=self.CATALOG_NAME, suffix='.tmp')
+        except OSError as e:
+            print(f"[W]: Could not save the image catalog to {self.rootpath}: {e}")
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self._folders, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._catalog_path())
+        except OSError as e:
+            os.remove(tmp_path)
+            print(f"[W]: Could not save the image catalog to {self.rootpath}: {e}")
+
+    def _index_names(self, names, index):
+        for name in names:
+            match = self._NAME_RE.search(name)
+            if match is None:
+                continue
+            key = match.group(0)
+            # Several files for the same minute: keep the first one in alphabetical order
+            if key not in index or name < index[key]:
+                index[key] = name
+
+    def refresh(self, folders:list[str]=None) -> bool:
+        '''
+        Rescans the folders whose mtime changed since the last refresh.
+
+        :param folders: list of str, names of the folders (relative to the root path) to refresh. If None, refreshes all folders of the root path.
+        :return changed: bool, True if at least one folder was rescanned.
+        '''
+        if folders is None:
+            folders = [f for f in os.listdir(self.rootpath) if os.path.isdir(os.path.join(self.rootpath, f))]
+        changed = False
+        for folder in folders:
+            mtime = os.stat(os.path.join(self.rootpath, folder)).st_mtime_ns
+            entry = self._folders.get(folder)
+            if entry is not None and entry['mtime'] == mtime:
+                continue
+            names = set(os.listdir(os.path.join(self.rootpath, folder)))
+            if entry is None or not entry['names'] <= names:
+                # New folder or files were removed: rebuild its index
+                index = {}
+                self._index_names(names, index)
+            else:
+                index = entry['index']
+                self._index_names(names - entry['names'], index)
+            self._folders[folder] = {'mtime': mtime, 'names': names, 'index': index}
+            changed = True
+        if changed and self.persist:
+            self._save()
+        return changed
+
+    def lookup(self, folder:str, hive_nb:int, rpi_num:int, dt:pd.Timestamp):
+        '''
+        Returns the path of the image taken by the given hive and RPi at the given datetime (minute precision), or None if there is none.
+        The datetime needs to be tz-aware. Call refresh() beforehand to pick up new captures.
+        '''
+        dt = dt.tz_convert('UTC')
+        key = f"hive{hive_nb}_rpi{rpi_num}_{dt.strftime('%y%m%d-%H%M')}"
+        name = self._folders[folder]['index'].get(key)
+        return os.path.join(self.rootpath, folder, name) if name is not None else None
+
+    def timestamps(self, folder:str) -> list[str]:
+        '''Returns the sorted 'hiveN_rpiM_yymmdd-HHMM' keys indexed for a folder.'''
+        return sorted(self._folders[folder]['index'])
+
+
+_catalogs = {} # Root path -> ImageCatalog, shared by all calls in the process
+
+def getImageCatalog(rootpath_imgs:str, persist:bool=True) -> ImageCatalog:
+    '''
+    Returns the (refreshed) image catalog of a root path, building it on the first call.
+    '''
+    key = os.path.abspath(str(rootpath_imgs))
+    if key not in _catalogs:
+        _catalogs[key] = ImageCatalog(rootpath_imgs, persist=persist)
+    _catalogs[key].refresh()
+    return _catalogs[key]
+
+
 @delayed
 def _fetch_single_datetime(dt:pd.Timestamp, paths, hive_nb:int):
     dt = dt.tz_convert('UTC')  # Ensure the datetime is in UTC. Will fail if not tz-aware.
@@ -28,9 +143,10 @@ def _fetch_single_datetime(dt:pd.Timestamp, paths, hive_nb:int):
     return dt, dt_result
 
 
-def fetchImagesPaths(rootpath_imgs:str, datetimes:list[pd.Timestamp], hive_nb:int, invalid_recovery_time:int = None, images_fill_limit:int = None, rpis:list[int]=[1,2,3,4], verbose=False):
+@traced(frames=lambda rootpath_imgs, datetimes, *args, **kwargs: len(datetimes))
+def fetchImagesPaths(rootpath_imgs:str, datetimes:list[pd.Timestamp], hive_nb:int, invalid_recovery_time:int = None, images_fill_limit:int = None, rpis:list[int]=[1,2,3,4], use_catalog:bool=True, verbose=False):
     '''
-    Fetches the images' paths for a specific hive at specific datetimes using Dask for parallel processing.
+    Fetches the images' paths for a specific hive at specific datetimes, using the ImageCatalog of the root path (or Dask for parallel folder scans).
 
     :param rootpath_imgs: str, root path to the images
     :param datetimes: list of pd.Timestamps, datetimes for which we want the images. Precision at minute level. Needs to be tz-aware.
@@ -38,6 +154,7 @@ def fetchImagesPaths(rootpath_imgs:str, datetimes:list[pd.Timestamp], hive_nb:in
     :param invalid_recovery_time: int, if specified, will filter out invalid datetimes including the given recovery time in minutes (when the hives were being opened + recovery time [min]).
     :param images_fill_limit: int, if provided, maximum number of images to fill the gaps with the previous images. If not provided, will not fill gaps (None in df).
     :param rpis: list of int, list of RPi numbers to consider. Default is [1,2,3,4].
+    :param use_catalog: bool, if True, looks the images up in the (persistent) ImageCatalog of the root path instead of listing the folders for every datetime.
     :return imgs_paths_filtered: pd.DataFrame, containing the image paths. Each row is a datetime, each column is a RPi. If validity is checked, the last column will indicate whether the datetime is valid or not (bool).
     '''
 
@@ -63,9 +180,16 @@ def fetchImagesPaths(rootpath_imgs:str, datetimes:list[pd.Timestamp], hive_nb:in
         if invalid_recovery_time is not None:
             print(f"Valid datetimes: {valid_datetimes}")
 
-    # Delayed processing
-    delayed_results = [_fetch_single_datetime(dt, paths, hive_nb) for dt in datetimes]
-    results = compute(*delayed_results)
+    if use_catalog:
+        catalog = getImageCatalog(rootpath_imgs)
+        results = []
+        for dt in datetimes:
+            dt_result = {os.path.basename(p)[:4]: catalog.lookup(os.path.basename(p), hive_nb, int(os.path.basename(p)[3]), dt) for p in paths}
+            results.append((dt, dt_result))
+    else:
+        # Delayed processing
+        delayed_results = [_fetch_single_datetime(dt, paths, hive_nb) for dt in datetimes]
+        results = compute(*delayed_results)
 
     # Build final DataFrame
     imgs_paths = pd.DataFrame(index=datetimes, columns=columns)
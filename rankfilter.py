@@ -0,0 +1,268 @@
+'''
+Rank (percentile) filters over sequences of uint8 frames, used by the percentile and median background filters.
+
+Instead of stacking and sorting a whole window for every output frame, RollingPercentile keeps a histogram of the
+current window per pixel and updates it with one frame in / one frame out, so that a sliding window
+only decodes and preprocesses each input frame once. tiled_percentile computes a single percentile image by horizontal
+bands, for stacks of full resolution images that do not fit in memory.
+'''
+
+import os, tempfile
+import numpy as np
+from math import ceil, floor
+
+
+def window_indexes(i:int, n_images:int, filter_length:int, frame_skip:int=1) -> range:
+    '''
+    Returns the indexes of the images in the window of the output image i (same window as the percentile filter's substack).
+    '''
+    start = max(0, i - frame_skip * floor(filter_length / 2))
+    stop = min(n_images, i + frame_skip * ceil(filter_length / 2))
+    return range(start, stop, frame_skip)
+
+
+def _lerp(a, b, gamma:float):
+    '''Same linear interpolation as np.percentile (method='linear'), so that results are identical.'''
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    diff_b_a = b - a
+    if gamma >= 0.5:
+        return b - diff_b_a * (1 - gamma)
+    return a + diff_b_a * gamma
+
+
+_MAX_WALK = 16 # Bins a pointer of RollingPercentile is walked by before its value is searched in the histogram
+_SEARCH_CHUNK = 2**16 # Pixels searched at once when placing the pointers of a new window
+
+
+class RollingPercentile:
+    '''
+    Per-pixel histogram of a window of uint8 frames supporting the insertion and removal of one frame at a time.
+    Each pixel also keeps two pointers on values of its window (the ranks below and above the last percentile) and the
+    number of window values below each. Adding or removing a frame updates one histogram bin and these counts per pixel,
+    and a percentile moves the pointers to the requested ranks, which are one rank away from the previous ones when the
+    window slides by one frame. Each update thus costs O(pixels), independently of the window length. The pointers of a
+    new window (after creation or clear()) are placed in one pass over the histograms.
+    Memory usage is 256 x pixels bytes (counts are uint8 up to a capacity of 255 frames, uint16 above).
+    '''
+
+    def __init__(self, shape:tuple, capacity:int):
+        '''
+        :param shape: tuple, shape of the frames (height, width) or (height, width, channels).
+        :param capacity: int, maximum number of frames in the window (at most 65535).
+        '''
+        self.shape = tuple(shape)
+        self.capacity = capacity
+        self.n = 0
+        self._n_pixels = int(np.prod(shape))
+        count_dtype = np.uint8 if capacity <= 255 else np.uint16
+        self._hist = np.zeros(256 * self._n_pixels, dtype=count_dtype) # (256, pixels) counts, flattened
+        self._pixels = np.arange(self._n_pixels, dtype=np.intp)
+        # Two pointers per pixel, on the ranks below and above a percentile (interpolated between them)
+        self._value = np.zeros((2, self._n_pixels), dtype=np.uint8)
+        self._below = np.zeros((2, self._n_pixels), dtype=count_dtype) # Number of values of the window smaller than the pointer
+        self._seeded = [False, False] # Pointers placed on the window, else they are searched rather than walked from 0
+
+    def _values(self, frame):
+        return np.ascontiguousarray(frame, dtype=np.uint8).reshape(-1)
+
+    def _bins(self, values, pixels):
+        '''Flat indexes in the histogram of the bins of values for the given pixels.'''
+        return values.astype(np.intp) * self._n_pixels + pixels
+
+    def add(self, frame:np.ndarray):
+        if self.n == self.capacity:
+            raise ValueError("RollingPercentile is full, remove a frame first")
+        values = self._values(frame)
+        self._hist[self._bins(values, self._pixels)] += 1 # One bin per pixel, no repeated index
+        self._below += values < self._value
+        self.n += 1
+
+    def remove(self, frame:np.ndarray):
+        '''Removes a frame previously added to the window.'''
+        if self.n == 0:
+            raise ValueError("RollingPercentile is empty")
+        values = self._values(frame)
+        self._hist[self._bins(values, self._pixels)] -= 1
+        self._below -= values < self._value
+        self.n -= 1
+
+    def clear(self):
+        self._hist.fill(0)
+        self._value.fill(0)
+        self._below.fill(0)
+        self._seeded = [False, False]
+        self.n = 0
+
+    def _search(self, k:int, pixels) -> tuple:
+        '''
+        k-th smallest value (from 0) of the window of the given pixels (slice or indexes) and the number of values below it,
+        from their histograms: cumulative counts over 16 groups of 16 bins find the group of the value, then over the 16 bins of that group.
+        '''
+        pixel_indexes = self._pixels[pixels]
+        below = np.zeros(len(pixel_indexes), dtype=self._below.dtype)
+        groups = self._hist.reshape(256, -1)[:, pixels].reshape(16, 16, -1).sum(axis=1, dtype=below.dtype)
+        group = self._cumulative_rank(groups, below, k)
+        first_bin = self._bins(group * 16, pixel_indexes)
+        bins = np.stack([self._hist[first_bin + i * self._n_pixels] for i in range(16)])
+        return group * 16 + self._cumulative_rank(bins, below, k), below
+
+    @staticmethod
+    def _cumulative_rank(counts, below, k:int) -> np.ndarray:
+        '''
+        Index of the first of the rows of counts (per pixel) at which the cumulative count, starting from below, exceeds k.
+        below is updated to the cumulative count before that row.
+        '''
+        index = np.zeros(counts.shape[1], dtype=np.uint8)
+        cum = below.copy()
+        for row in counts[:-1]:
+            cum += row
+            before = cum <= k # Values of the row are all among the k smallest
+            index += before
+            np.copyto(below, cum, where=before)
+        return index
+
+    def _select(self, k:int, pointer:int=0) -> np.ndarray:
+        '''
+        Moves a pointer of each pixel to the k-th smallest value (from 0) of its window, and returns the values.
+        The pointers are walked bin by bin from their previous values, which is cheap for a window updated by a few frames.
+        The pointers of a new window are placed by chunks of pixels, and those still walking after _MAX_WALK bins (gaps in
+        the histogram) are searched, with _search().
+        '''
+        hist, value, below = self._hist, self._value[pointer], self._below[pointer]
+        if not self._seeded[pointer]:
+            for start in range(0, self._n_pixels, _SEARCH_CHUNK):
+                pixels = slice(start, min(start + _SEARCH_CHUNK, self._n_pixels))
+                value[pixels], below[pixels] = self._search(k, pixels)
+            self._seeded[pointer] = True
+            return value
+        # Pointers below the k-th value: move up, skipping the values of the pointer
+        idx = np.flatnonzero(below + hist[self._bins(value, self._pixels)] <= k)
+        for _ in range(_MAX_WALK):
+            if not idx.size:
+                break
+            below[idx] += hist[self._bins(value[idx], idx)]
+            value[idx] += 1
+            idx = idx[below[idx] + hist[self._bins(value[idx], idx)] <= k]
+        if idx.size:
+            value[idx], below[idx] = self._search(k, idx)
+        # Pointers above it: move down, counting the values below the pointer out
+        idx = np.flatnonzero(below > k)
+        for _ in range(_MAX_WALK):
+            if not idx.size:
+                break
+            value[idx] -= 1
+            below[idx] -= hist[self._bins(value[idx], idx)]
+            idx = idx[below[idx] > k]
+        if idx.size:
+            value[idx], below[idx] = self._search(k, idx)
+        return value
+
+    def percentile(self, percentile:float=75) -> np.ndarray:
+        '''
+        Returns the percentile image of the frames in the window, identical to np.percentile(window, percentile, axis=0).astype(np.uint8).
+        '''
+        if self.n == 0:
+            raise ValueError("RollingPercentile is empty")
+        virtual_index = (self.n - 1) * (percentile / 100)
+        previous_index = floor(virtual_index)
+        next_index = min(previous_index + 1, self.n - 1)
+        gamma = virtual_index - previous_index
+        previous = self._select(previous_index)
+        if gamma == 0: # Interpolation not needed, as np.percentile returns the previous value
+            return previous.reshape(self.shape).copy()
+        result = _lerp(previous, self._select(next_index, pointer=1), gamma)
+        return result.astype(np.uint8).reshape(self.shape)
+
+
+def rolling_percentile(load_image, n_images:int, idxs:list, filter_length:int=40, percentile:float=75, frame_skip:int=1, verbose:bool=False):
+    '''
+    Generator yielding the percentile image of the window of each output index in idxs, in order.
+    Each input image is loaded once, kept while it belongs to a window and released afterwards.
+
+    :param load_image: callable, load_image(j) returns the (preprocessed) uint8 image j of the sequence.
+    :param n_images: int, number of images in the sequence.
+    :param idxs: list of int, indexes of the output images. Sorted indexes give the smallest number of updates.
+    :param filter_length: int, number of images in a window.
+    :param percentile: float, percentile to compute (50 for the median).
+    :param frame_skip: int, step between the images of a window.
+    '''
+    ring = {} # Image index -> image, for the images of the current window only
+    rank_state = None
+    current = set()
+    for i in idxs:
+        window = set(window_indexes(i, n_images, filter_length, frame_skip))
+        if current and not (window & current):
+            # No overlap with the previous window: start over rather than removing everything
+            rank_state.clear()
+            ring.clear()
+            current = set()
+        for j in sorted(current - window):
+            rank_state.remove(ring.pop(j))
+        for j in sorted(window - current):
+            ring[j] = load_image(j)
+            if rank_state is None:
+                rank_state = RollingPercentile(ring[j].shape, filter_length)
+            rank_state.add(ring[j])
+        if verbose:
+            print(f"Output {i}: {len(window - current)} images added, {len(current - window)} removed")
+        current = window
+        yield rank_state.percentile(percentile)
+
+
+def tiled_percentile(paths:list, read, percentile:float=50, max_ram_bytes:int=4 * 2**30, tmp_dir:str=None, out:np.ndarray=None, verbose:bool=False) -> np.ndarray:
+    '''
+    Percentile image of a list of uint8 images, computed by horizontal bands so that memory stays below max_ram_bytes.
+    Each image is read once. If the stack does not fit in memory, its bands are first written to a temporary file on disk
+    (laid out band by band, so that each band is read back contiguously). Same output as np.percentile(stack, percentile, axis=0).astype(np.uint8).
+
+    :param paths: list, paths of the images (or anything read() accepts).
+    :param read: callable, read(path) returns the image as a uint8 np.ndarray (e.g. skimage.io.imread).
+    :param percentile: float, percentile to compute (50 for the median).
+    :param max_ram_bytes: int, approximate memory ceiling in bytes for the images and temporaries.
+    :param tmp_dir: str, directory of the temporary file (default: system temporary directory).
+    :param out: np.ndarray, optional preallocated uint8 output with the shape of the images.
+    '''
+    n = len(paths)
+    first = read(paths[0])
+    height = first.shape[0]
+    row_shape = first.shape[1:]
+    row_bytes = int(np.prod(row_shape))
+    if out is None:
+        out = np.empty(first.shape, dtype=np.uint8)
+
+    # Band stack (n rows of uint8 per image row) and the float64 percentile temporaries (~16 bytes per output value)
+    budget = max_ram_bytes - first.nbytes
+    band_height = int(min(height, max(1, budget // (row_bytes * (n + 16)))))
+    n_bands = ceil(height / band_height)
+    in_memory = n * first.nbytes <= budget - 16 * band_height * row_bytes
+    if verbose:
+        print(f"{n} images of shape {first.shape}: {n_bands} bands of {band_height} rows, stack {'in memory' if in_memory else 'on disk'}")
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        if in_memory:
+            stack = np.empty((n,) + first.shape, dtype=np.uint8)
+        else:
+            stack = np.lib.format.open_memmap(os.path.join(tmp, 'bands.npy'), mode='w+', dtype=np.uint8,
+                                              shape=(n_bands, n, band_height) + row_shape)
+        for i, path in enumerate(paths):
+            img = first if i == 0 else read(path)
+            if img.shape != first.shape:
+                raise ValueError(f"Image {path} has shape {img.shape}, expected {first.shape}")
+            if in_memory:
+                stack[i] = img
+                continue
+            for b in range(n_bands):
+                rows = slice(b * band_height, min(height, (b + 1) * band_height))
+                stack[b, i, :rows.stop - rows.start] = img[rows]
+        del first, img
+
+        for b in range(n_bands):
+            rows = slice(b * band_height, min(height, (b + 1) * band_height))
+            if in_memory:
+                band = stack[:, rows]
+            else:
+                band = np.array(stack[b, :, :rows.stop - rows.start])
+            out[rows] = np.percentile(band, percentile, axis=0, overwrite_input=True).astype(np.uint8)
+        del stack
+    return out
@@ -0,0 +1,139 @@
+'''
+Persistent cache of filter outputs (percentile and median backgrounds), so that notebooks and batch scripts
+load a background computed before instead of filtering the same images again.
+
+Outputs are content-addressed: the key hashes the input files (path, size and mtime, so a modified image is a miss),
+the filter type and parameters, and the preprocessing version (Preprocessing.preproc.PREPROC_VERSION).
+They are stored losslessly, as PNG for uint8 images and as .npy otherwise, in a directory bounded in bytes
+where the least recently used outputs are evicted first.
+'''
+
+import os, json, hashlib, threading, tempfile
+import cv2
+import numpy as np
+from Preprocessing.preproc import PREPROC_VERSION
+
+
+class ResultCache:
+    '''
+    On-disk cache of filter outputs, safe to share between threads and processes (files are written atomically).
+    '''
+
+    def __init__(self, cache_dir:str, max_bytes:int=10 * 2**30):
+        '''
+        :param cache_dir: str, directory of the cache (created if needed).
+        :param max_bytes: int, size budget of the directory in bytes. The default (10 GiB) holds ~1000 gray 2592x4608 PNG backgrounds.
+        '''
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(paths:list, filter_type:str, params:dict) -> str:
+        '''
+        Key of the output of a filter over a list of input files.
+
+        :param paths: list of str, paths of the input files, in the order the filter uses them.
+        :param filter_type: str, e.g. 'percentile' or 'median'.
+        :param params: dict, filter parameters (e.g. filter_length, percentile, frame_skip), JSON serializable.
+        '''
+        h = hashlib.sha1()
+        h.update(json.dumps({'filter': filter_type, 'params': params, 'preproc': PREPROC_VERSION}, sort_keys=True, default=str).encode())
+        for path in paths:
+            st = os.stat(path)
+            h.update(f"\n{os.path.abspath(str(path))}|{st.st_size}|{st.st_mtime_ns}".encode())
+        return h.hexdigest()
+
+    def _paths(self, key:str):
+        return os.path.join(self.cache_dir, key + '.png'), os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key:str) -> np.ndarray:
+        '''Returns the cached output, or None if there is none.'''
+        png_path, npy_path = self._paths(key)
+        img = None
+        for path in (png_path, npy_path):
+            if os.path.exists(path):
+                try:
+                    img = cv2.imread(path, cv2.IMREAD_UNCHANGED) if path == png_path else np.load(path)
+                    os.utime(path) # Most recently used
+                except (OSError, ValueError): # Evicted or being replaced by another process
+                    img = None
+                break
+        with self._lock:
+            if img is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return img
+
+    def put(self, key:str, img:np.ndarray):
+        '''Stores an output (uint8 gray or BGR images as PNG, other arrays as .npy), then evicts the oldest outputs above max_bytes.'''
+        img = np.asarray(img)
+        as_png = img.dtype == np.uint8 and (img.ndim == 2 or (img.ndim == 3 and img.shape[2] in (3, 4)))
+        path = self._paths(key)[0 if as_png else 1]
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.png' if as_png else '.npy')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if as_png:
+                    ok, buffer = cv2.imencode('.png', img)
+                    if not ok:
+                        raise ValueError(f"Could not encode an output of shape {img.shape} as PNG")
+                    f.write(buffer.tobytes())
+                else:
+                    np.save(f, img)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._evict()
+
+    def get_or_compute(self, paths:list, filter_type:str, params:dict, compute) -> np.ndarray:
+        '''Returns the cached output of the filter over paths, calling compute() and storing its result on a miss.'''
+        key = self.key(paths, filter_type, params)
+        img = self.get(key)
+        if img is None:
+            img = np.asarray(compute())
+            self.put(key, img)
+        return img
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(('.png', '.npy')) or name.startswith('tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError: # Evicted by another process
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, name))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                with self._lock:
+                    self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, name in self._entries():
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'outputs': len(entries), 'bytes': sum(size for _, size, _ in entries), 'max_bytes': self.max_bytes}
@@ -0,0 +1,180 @@
+'''
+Lightweight tracing of the pipeline stages (decoding, preprocessing, filters, contours, optical flow, video writing).
+
+Disabled by default, in which case spans and traced functions cost a flag check. Once enabled (tracing.enable(), or the
+ABC_TRACE=1 environment variable), each span records its wall time, thread, frames processed, bytes read, the resident memory
+(RSS) of the process at its start and end, and the peak RSS of the process so far. They can be exported as a Chrome/Perfetto
+trace (chrome://tracing, ui.perfetto.dev) or summarized per stage.
+The RSS change of a span is that of the whole process, including the allocations of other threads running meanwhile, and
+the memory allocated and freed within the span is not seen. The current RSS is read from /proc (Linux), and is missing elsewhere.
+Spans are recorded per process: with a process pool, enable and export in each worker.
+
+    import tracing
+    tracing.enable()
+    ... run the pipeline ...
+    tracing.export_chrome_trace('trace.json')
+    print(tracing.summary())
+'''
+
+import os, sys, json, time, resource, threading, functools
+import pandas as pd
+
+_enabled = os.environ.get('ABC_TRACE', '0') not in ('', '0')
+_events = [] # Finished spans, appended from any thread
+_t0 = time.perf_counter_ns()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled() -> bool:
+    return _enabled
+
+def reset():
+    '''Discards the recorded spans.'''
+    _events.clear()
+
+
+_PAGE_SIZE = resource.getpagesize()
+
+
+def _rss_bytes() -> int:
+    '''Current RSS of the process, or -1 where /proc/self/statm is not available (e.g. macOS).'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return -1
+
+
+def _process_peak_rss_bytes() -> int:
+    '''Highest RSS of the process since it started (not of a span).'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # Bytes on macOS, kilobytes on Linux
+
+
+class Span:
+    '''A timed stage. frames and bytes can be incremented inside the with block.'''
+    __slots__ = ('name', 'frames', 'bytes', '_start', '_rss_start')
+
+    def __init__(self, name:str, frames:int=0, nbytes:int=0):
+        self.name = name
+        self.frames = frames
+        self.bytes = nbytes
+
+    def __enter__(self):
+        self._rss_start = _rss_bytes()
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter_ns()
+        _events.append((self.name, self._start - _t0, end - self._start, threading.get_ident(), self.frames, self.bytes,
+                        self._rss_start, _rss_bytes(), _process_peak_rss_bytes()))
+        return False
+
+
+class _NullSpan:
+    '''Span used when tracing is disabled: records nothing.'''
+    __slots__ = ('frames', 'bytes')
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name:str, frames:int=0, nbytes:int=0):
+    '''
+    Context manager timing a stage, e.g. `with tracing.span('decode', frames=1, nbytes=os.path.getsize(path)):`.
+    Returns a shared no-op context when tracing is disabled.
+    '''
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, frames, nbytes)
+
+
+def traced(name:str=None, frames=1, path_arg:int=None):
+    '''
+    Decorator recording each call of a function as a span.
+
+    :param name: str, name of the stage. Default: the function name.
+    :param frames: int, or callable(*args, **kwargs) returning the number of frames processed by a call.
+    :param path_arg: int, position of an argument holding the path of a file read by the function, whose size is counted as bytes read.
+    '''
+    def decorator(f):
+        stage = name or f.__name__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return f(*args, **kwargs)
+            n_frames = frames(*args, **kwargs) if callable(frames) else frames
+            nbytes = 0
+            if path_arg is not None and len(args) > path_arg:
+                try:
+                    nbytes = os.path.getsize(args[path_arg])
+                except (OSError, TypeError): # Not a path, e.g. an array
+                    pass
+            with Span(stage, n_frames, nbytes):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def events() -> pd.DataFrame:
+    '''
+    Recorded spans, one row each: name, start_s, duration_s, thread, frames, bytes, rss_start_bytes, rss_end_bytes, rss_delta_bytes
+    (NaN where the current RSS is not available) and process_peak_rss_bytes (highest RSS of the process up to the end of the span).
+    '''
+    df = pd.DataFrame([(name, start / 1e9, duration / 1e9, tid, frames, nbytes, rss_start, rss_end, peak)
+                       for name, start, duration, tid, frames, nbytes, rss_start, rss_end, peak in list(_events)],
+                      columns=['name', 'start_s', 'duration_s', 'thread', 'frames', 'bytes', 'rss_start_bytes', 'rss_end_bytes', 'process_peak_rss_bytes'])
+    df[['rss_start_bytes', 'rss_end_bytes']] = df[['rss_start_bytes', 'rss_end_bytes']].where(df[['rss_start_bytes', 'rss_end_bytes']] >= 0)
+    df.insert(8, 'rss_delta_bytes', df['rss_end_bytes'] - df['rss_start_bytes'])
+    return df
+
+
+def summary() -> pd.DataFrame:
+    '''
+    Per-stage summary of the recorded spans, sorted by total time: calls, total and mean wall time, frames, bytes, throughput,
+    the largest RSS increase during a call (max_rss_delta_MB, see the module docstring), the highest RSS at the end of a call
+    (max_rss_MB) and the peak RSS of the process when the stage last ended (process_peak_rss_MB, which includes earlier stages).
+    Nested spans are counted in each stage.
+    '''
+    columns = ['calls', 'total_s', 'mean_ms', 'frames', 'bytes', 'frames_per_s', 'MB_per_s', 'max_rss_delta_MB', 'max_rss_MB', 'process_peak_rss_MB']
+    df = events()
+    if len(df) == 0:
+        return pd.DataFrame(columns=columns)
+    grouped = df.groupby('name')
+    table = pd.DataFrame({'calls': grouped.size(), 'total_s': grouped['duration_s'].sum(), 'frames': grouped['frames'].sum(),
+                          'bytes': grouped['bytes'].sum(), 'max_rss_delta_MB': grouped['rss_delta_bytes'].max() / 2**20,
+                          'max_rss_MB': grouped['rss_end_bytes'].max() / 2**20, 'process_peak_rss_MB': grouped['process_peak_rss_bytes'].max() / 2**20})
+    table['mean_ms'] = 1000 * table['total_s'] / table['calls']
+    table['frames_per_s'] = table['frames'] / table['total_s']
+    table['MB_per_s'] = table['bytes'] / 2**20 / table['total_s']
+    return table[columns].sort_values('total_s', ascending=False)
+
+
+def export_chrome_trace(path:str):
+    '''Writes the recorded spans as a Chrome trace (JSON "X" events), to open in chrome://tracing or ui.perfetto.dev.'''
+    pid = os.getpid()
+    trace_events = [{'name': name, 'ph': 'X', 'ts': start / 1000, 'dur': duration / 1000, 'pid': pid, 'tid': tid,
+                     'args': {'frames': frames, 'bytes': nbytes, 'rss_MB': round(rss_end / 2**20, 1) if rss_end >= 0 else None,
+                              'rss_delta_MB': round((rss_end - rss_start) / 2**20, 1) if min(rss_start, rss_end) >= 0 else None,
+                              'process_peak_rss_MB': round(peak / 2**20, 1)}}
+                    for name, start, duration, tid, frames, nbytes, rss_start, rss_end, peak in list(_events)]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)